@@ -0,0 +1,173 @@
+"""
+ Description: Conversion of D-Bus replies to plain python types
+"""
+
+import time
+import json
+import dbus
+
+
+DICT = 1
+LIST = 2
+
+CONVERSIONS = {dbus.Boolean: bool,
+               dbus.Byte: int,
+               dbus.Int16: int,
+               dbus.Int32: int,
+               dbus.Int64: int,
+               dbus.UInt16: int,
+               dbus.UInt32: int,
+               dbus.UInt64: int,
+               dbus.Double: float,
+               dbus.String: unicode,
+               dbus.ObjectPath: unicode,
+               dbus.Signature: unicode,
+               dbus.Dictionary: DICT,
+               dbus.Array: LIST,
+               dbus.Struct: LIST,
+               dict: DICT,
+               list: LIST,
+               tuple: LIST}
+"""Conversion by exact type, one dictionary lookup per value"""
+
+PLAIN_TYPES = set([bool, int, long, float, unicode, type(None)])
+"""Types returned as they are"""
+
+
+def to_native_value(value):
+    """Returns the plain python value of a D-Bus scalar, strings are returned
+    as unicode like json.loads does"""
+    if isinstance(value, (bool, dbus.Boolean)):
+        return bool(value)
+    elif isinstance(value, (int, long)):
+        return int(value)
+    elif isinstance(value, float):
+        return float(value)
+    elif isinstance(value, unicode):
+        return unicode(value)
+    elif isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def kind_of(value):
+    """Returns DICT, LIST, a conversion function or None for plain values"""
+    value_type = type(value)
+    if value_type in PLAIN_TYPES:
+        return None
+    kind = CONVERSIONS.get(value_type)
+    if kind is not None:
+        return kind
+    elif isinstance(value, dict):
+        return DICT
+    elif isinstance(value, (list, tuple)):
+        return LIST
+    return to_native_value
+
+
+def to_native(data):
+    """Returns a copy of data with the dbus types, dbus.Dictionary,
+    dbus.Array, dbus.Struct, dbus.Byte etc., replaced by dict, list and plain
+    scalars. Walks the data once with an explicit stack, nothing is encoded
+    on the way"""
+    kind = kind_of(data)
+    if kind is None:
+        return data
+    elif kind is DICT:
+        result = {}
+    elif kind is LIST:
+        result = []
+    else:
+        return kind(data)
+    stack = [(data, result)]
+    while len(stack):
+        source, target = stack.pop(-1)
+        if isinstance(target, dict):
+            for key, value in source.iteritems():
+                kind = kind_of(key)
+                if kind is not None:
+                    key = kind(key)
+                kind = kind_of(value)
+                if kind is None:
+                    target[key] = value
+                elif kind is DICT:
+                    target[key] = item = {}
+                    stack.append((value, item))
+                elif kind is LIST:
+                    target[key] = item = []
+                    stack.append((value, item))
+                else:
+                    target[key] = kind(value)
+        else:
+            append = target.append
+            for value in source:
+                kind = kind_of(value)
+                if kind is None:
+                    append(value)
+                elif kind is DICT:
+                    item = {}
+                    append(item)
+                    stack.append((value, item))
+                elif kind is LIST:
+                    item = []
+                    append(item)
+                    stack.append((value, item))
+                else:
+                    append(kind(value))
+    return result
+
+
+def fix_byte(it, key, parent):
+    """Conversion used before to_native, kept for the benchmark"""
+    if (isinstance(it, dbus.Array)):
+        for i in range(0, len(it)):
+            fix_byte(it[i], i, it)
+    elif (isinstance(it, dict)):
+        for key in it.keys():
+            fix_byte(it[key], key, it)
+    elif (isinstance(it, dbus.Byte)):
+        if key is not None:
+            parent[key] = int(it)
+    elif (isinstance(it, dbus.Double)):
+        if key is not None:
+            parent[key] = float(it)
+
+
+def make_subtree(count):
+    """Returns a synthetic enumerated subtree of count inventory objects"""
+    data = dbus.Dictionary()
+    for i in range(0, count):
+        path = dbus.ObjectPath('/org/openbmc/inventory/system/item%d' % i)
+        data[path] = dbus.Dictionary({
+            dbus.String(u'fru_type'): dbus.String(u'DIMM'),
+            dbus.String(u'present'): dbus.String(u'True'),
+            dbus.String(u'Serial Number'): dbus.String(u'%016d' % i),
+            dbus.String(u'Part Number'): dbus.String(u'PN%d' % i),
+            dbus.String(u'value'): dbus.Double(i * 0.5),
+            dbus.String(u'count'): dbus.Int32(i),
+            dbus.String(u'fru'): dbus.Array([dbus.Byte(b) for b in
+                                             range(0, 32)])})
+    return data
+
+
+if __name__ == '__main__':
+    count = 10000
+    runs = 5
+    subtree = make_subtree(count)
+    start = time.time()
+    for _ in range(0, runs):
+        data = make_subtree(count)
+        fix_byte(data, None, None)
+        json.loads(json.dumps(data))
+    legacy = (time.time() - start) / runs
+    start = time.time()
+    for _ in range(0, runs):
+        make_subtree(count)
+    build = (time.time() - start) / runs
+    start = time.time()
+    for _ in range(0, runs):
+        to_native(subtree)
+    native = (time.time() - start) / runs
+    print "%d objects, mean of %d runs" % (count, runs)
+    print "fix_byte + json round trip : %.1f ms" % ((legacy - build) * 1000)
+    print "to_native                  : %.1f ms" % (native * 1000)
@@ -4,10 +4,17 @@
  Description:
 """
 
-import json
+import time
+import threading
 import dbus
+import dbus.connection
+import dbus.mainloop.glib
+import gobject
 import obmc.mapper
 import obmc.utils.misc
+from obmc_dbus_convert import to_native
+from redfish_metrics import observe_dbus_call
+from redfish_inventory_snapshot import InventorySnapshot, diff_inventory
 
 
 POWER_CONTROL = {'On': 'powerOn',
@@ -32,6 +39,37 @@ SENSORS_INFO = {'AMBIENT': 'ambient',
                 'POWER_USER_CAP': 'user_cap',
                 'BOOT_COUNT': 'BootCount'}
 
+INVENTORY_PATH = '/org/openbmc/inventory'
+
+SENSORS_PATH = '/org/openbmc/sensors'
+
+INVENTORY_SNAPSHOT_FP = '/var/tmp/inventory.snapshot.json'
+"""Inventory of the last run, served at startup while it is checked"""
+
+SNAPSHOT_CHECK_RETRY_SECONDS = 5
+"""Wait after a failed check of the inventory snapshot before the next one,
+doubled after every further failure up to SNAPSHOT_CHECK_RETRY_MAX_SECONDS"""
+SNAPSHOT_CHECK_RETRY_MAX_SECONDS = 300
+
+INVENTORY_NOTIFY_DELAY = 0.5
+"""Seconds the inventory patches of the signals are gathered before the
+listeners are called once with all the paths patched meanwhile"""
+
+SENSOR_FIELDS = ['value', 'units', 'filename', 'error']
+
+SENSOR_SAMPLE_INTERVAL = 5
+"""Seconds between two enumerations of the sensors by the sampler"""
+
+DBUS_CALL_TIMEOUT = 25
+"""Seconds to wait for the reply of an asynchronous D-Bus call"""
+
+STALE_PROXY_ERRORS = ['org.freedesktop.DBus.Error.ServiceUnknown',
+                      'org.freedesktop.DBus.Error.NameHasNoOwner',
+                      'org.freedesktop.DBus.Error.NoReply',
+                      'org.freedesktop.DBus.Error.Disconnected']
+"""Errors of a call through a proxy of a daemon that is gone, the proxies of
+its bus name are dropped"""
+
 # System states
 #   state can change to next state in 2 ways:
 #   - a process emits a GotoSystemState signal with state name to goto
@@ -66,38 +104,418 @@ LED_TYPE = ['identify', 'power', 'heartbeat']
 #                    'MEMORY_BUFFER']
 
 
-def fix_byte(it, key, parent):
-    if (isinstance(it, dbus.Array)):
-        for i in range(0, len(it)):
-            fix_byte(it[i], i, it)
-    elif (isinstance(it, dict)):
-        for key in it.keys():
-            fix_byte(it[key], key, it)
-    elif (isinstance(it, dbus.Byte)):
-        if key is not None:
-            parent[key] = int(it)
-    elif (isinstance(it, dbus.Double)):
-        if key is not None:
-            parent[key] = float(it)
+class DBusFuture(object):
+    """Reply of a D-Bus call issued on the D-Bus thread, converted to python
+    types and passed through convert when it arrives"""
+
+    def __init__(self, convert=None):
+        self.convert = convert
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def set_result(self, *reply):
+        try:
+            if len(reply) == 0:
+                value = None
+            elif len(reply) == 1:
+                value = to_native(reply[0])
+            else:
+                value = to_native(reply)
+            if self.convert is not None:
+                value = self.convert(value)
+            self.value = value
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=DBUS_CALL_TIMEOUT):
+        """Wait for the reply and return it, raise the error of the call"""
+        if not self.done.wait(timeout):
+            raise RuntimeError("D-Bus call timed out")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def wait_all(futures, timeout=DBUS_CALL_TIMEOUT):
+    """Wait for all the futures and return their values in order. Failed
+    calls are printed and their value is None. The calls run concurrently,
+    waiting takes as long as the slowest"""
+    deadline = time.time() + timeout
+    values = []
+    for future in futures:
+        try:
+            values.append(future.result(max(0, deadline - time.time())))
+        except Exception as e:
+            print e
+            values.append(None)
+    return values
+
+
+class DBusProxy(object):
+    """One interface of a D-Bus object with its methods, resolved on first
+    use"""
+
+    def __init__(self, obj, interface):
+        self.obj = obj
+        self.interface = interface
+        self.methods = {}
+
+    def get_method(self, method):
+        mthd = self.methods.get(method)
+        if mthd is None:
+            mthd = self.obj.get_dbus_method(method, self.interface)
+            self.methods[method] = mthd
+        return mthd
+
+
+class DBusProxyCache(object):
+    """
+    Proxies of the D-Bus objects, key = bus name, object path and interface.
+    Proxies are made without introspection, every call names its interface.
+    A proxy is bound to the daemon that owned the bus name when it was made,
+    so the proxies of a bus name are dropped when its owner changes, or a
+    call fails as if the daemon was gone, and the next call makes new ones
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.lock = threading.Lock()
+        self.proxies = {}
+        self.generation = 0
+        """Bumped by every drop, a proxy made meanwhile is not kept"""
+        self.enabled = True
+        """Make a new introspected proxy for every call when False, the way
+        it was done before the cache, to measure it"""
+
+    def get_proxy(self, bus_name, path, interface):
+        if self.enabled is False:
+            return DBusProxy(self.bus.get_object(bus_name, path), interface)
+        key = (bus_name, path, interface)
+        proxy = self.proxies.get(key)
+        if proxy is None:
+            generation = self.generation
+            obj = self.bus.get_object(bus_name, path, introspect=False)
+            proxy = DBusProxy(obj, interface)
+            with self.lock:
+                if generation == self.generation:
+                    proxy = self.proxies.setdefault(key, proxy)
+        return proxy
+
+    def get_method(self, bus_name, path, interface, method):
+        return self.get_proxy(bus_name, path, interface).get_method(method)
+
+    def forget(self, bus_name):
+        """Drop the proxies of the bus name"""
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.proxies if key[0] == bus_name]:
+                del self.proxies[key]
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        if any(key[0] == name for key in self.proxies.keys()):
+            self.forget(str(name))
+
+    def call_failed(self, bus_name, error):
+        if (isinstance(error, dbus.exceptions.DBusException) and
+                error.get_dbus_name() in STALE_PROXY_ERRORS):
+            self.forget(bus_name)
+
+
+class InventoryIndex(object):
+    """Inventory objects indexed once per inventory generation, the indexed
+    objects are shared with inventory_data and must not be modified"""
+
+    def __init__(self, inventory_data, generation):
+        self.generation = generation
+
+        self.by_type = {}
+        """Dictionary of objects by fru_type, value = {path: object}"""
+
+        self.children = {}
+        """Dictionary of object paths by the path of their parent"""
+
+        for op, obj in inventory_data.items():
+            fru_type = obj.get('fru_type')
+            if fru_type is not None:
+                self.by_type.setdefault(fru_type, {})[op] = obj
+            parent = op.rsplit('/', 1)[0]
+            self.children.setdefault(parent, []).append(op)
+
+
+class SensorSnapshot(object):
+    """Readings of all the sensors taken by one enumeration, key=name of the
+    sensor object. Never modified once published"""
+
+    def __init__(self, readings, generation, timestamp=None):
+        self._readings = readings
+        self.generation = generation
+        """Bumped for every snapshot published by the sampler"""
+        self.timestamp = timestamp
+        if timestamp is None:
+            self.timestamp = time.time()
+
+    def age(self):
+        """Returns the seconds since the readings were taken"""
+        return time.time() - self.timestamp
+
+    def get(self, name):
+        """Returns a copy of the fields of the sensor, empty if not found"""
+        return dict(self._readings.get(name, {}))
+
+    def names(self):
+        return self._readings.keys()
+
+
+class SensorSampler(threading.Thread):
+    """Enumerates the sensors once every interval and publishes the readings
+    as a SensorSnapshot shared by all the readers"""
+
+    def __init__(self, provider, interval=SENSOR_SAMPLE_INTERVAL):
+        super(SensorSampler, self).__init__(name="SensorSampler")
+        self.daemon = True
+        self.provider = provider
+        self.interval = interval
+        self.snapshot = None
+        self.refresh_lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print e
+            time.sleep(self.interval)
+
+    def refresh(self, max_age=None):
+        """Enumerate the sensors and publish a new snapshot, unless another
+        thread published one younger than max_age while waiting"""
+        with self.refresh_lock:
+            snapshot = self.snapshot
+            if (snapshot is not None and max_age is not None and
+                    snapshot.age() <= max_age):
+                return snapshot
+            data = self.provider.get_enumerated_obj('org/openbmc/sensors')
+            pydata = to_native(data)
+            readings = {}
+            for op, values in pydata.items():
+                readings[op.split('/')[-1]] = dict(
+                    (item, value) for item, value in values.items()
+                    if item in SENSOR_FIELDS)
+            snapshot = SensorSnapshot(readings, self.next_generation())
+            self.snapshot = snapshot
+            return snapshot
+
+    def patch(self, name, changed, invalidated=None, removed=False):
+        """Publish a copy of the snapshot with the fields of one sensor
+        updated, or the sensor dropped if removed. The copy keeps the time
+        of the enumeration, the other sensors were not read again"""
+        with self.refresh_lock:
+            snapshot = self.snapshot
+            if snapshot is None:
+                return
+            readings = dict(snapshot._readings)
+            if removed is True:
+                readings.pop(name, None)
+            else:
+                reading = dict(readings.get(name, {}))
+                for item, value in changed.items():
+                    if item in SENSOR_FIELDS:
+                        reading[item] = value
+                for item in invalidated or []:
+                    reading.pop(item, None)
+                readings[name] = reading
+            self.snapshot = SensorSnapshot(readings, self.next_generation(),
+                                           snapshot.timestamp)
+
+    def next_generation(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return 1
+        return snapshot.generation + 1
+
+    def get_snapshot(self, max_age=None):
+        """Returns the published snapshot, or a fresh one if there is none yet
+        or the published one is older than max_age seconds"""
+        snapshot = self.snapshot
+        if snapshot is None or (max_age is not None and
+                                snapshot.age() > max_age):
+            snapshot = self.refresh(max_age)
+        return snapshot
 
 
 class ObmcRedfishProviders(object):
     """OpenBMC Redfish Providers using DBUS"""
 
-    def __init__(self):
-        """Initialize the class"""
-        self.bus = dbus.SystemBus()
+    def __init__(self, sensor_interval=SENSOR_SAMPLE_INTERVAL,
+                 snapshot_path=INVENTORY_SNAPSHOT_FP):
+        """Initialize the class, pass None as snapshot_path to enumerate the
+        inventory at every start"""
+        gobject.threads_init()
+        dbus.mainloop.glib.threads_init()
+        self.bus = dbus.SystemBus(mainloop=dbus.mainloop.glib.DBusGMainLoop())
         self.mapper = obmc.mapper.Mapper(self.bus)
+        self.init_state(sensor_interval, snapshot_path)
+        self.watch_signals()
+
+    def init_state(self, sensor_interval, snapshot_path):
+        """Set up the caches and start the sensor sampler, everything but the
+        connection to the bus which must be made before"""
+        self.proxies = DBusProxyCache(self.bus)
 
         self.inventory_data = None
 
-    def find_inventory_object(self, name, object):
-        merged = {}
-        for op in object.keys():
-            for property, value in object[op].items():
-                if property == 'fru_type' and value == name:
-                    merged[op] = object[op]
-        return merged
+        self.inventory_generation = 0
+        """Bumped every time inventory_data is loaded or patched"""
+
+        self.inventory_lock = threading.RLock()
+
+        self.inventory_index = None
+        """InventoryIndex of inventory_data, rebuilt when the generation
+        changes"""
+
+        self.inventory_snapshot = None
+        if snapshot_path is not None:
+            self.inventory_snapshot = InventorySnapshot(snapshot_path)
+
+        self.inventory_listeners = []
+        """Called with the paths of the inventory objects the check of the
+        snapshot found changed or the signals patched, never on the signal
+        thread"""
+
+        self.notify_paths = set()
+        """Paths patched by signals since the listeners were last called"""
+
+        self.notify_timer = None
+        """Timer calling the listeners with notify_paths, None when no patch
+        is pending"""
+
+        self.patched_paths = None
+        """Paths patched by signals while the snapshot is checked, None when
+        it is not"""
+
+        self.snapshot_check_thread = None
+
+        self.sensor_sampler = SensorSampler(self, sensor_interval)
+        self.sensor_sampler.start()
+
+    def watch_signals(self):
+        """Subscribe to the signals that change the inventory and the sensors
+        and run the loop that dispatches them on its own thread"""
+        namespaces = [INVENTORY_PATH, SENSORS_PATH]
+        self.add_signal_match(
+            self.properties_changed, 'org.freedesktop.DBus.Properties',
+            'PropertiesChanged',
+            ["path_namespace='%s'" % path for path in namespaces],
+            path_keyword='path')
+        self.add_signal_match(
+            self.interfaces_added, 'org.freedesktop.DBus.ObjectManager',
+            'InterfacesAdded',
+            ["arg0path='%s/'" % path for path in namespaces])
+        self.add_signal_match(
+            self.interfaces_removed, 'org.freedesktop.DBus.ObjectManager',
+            'InterfacesRemoved',
+            ["arg0path='%s/'" % path for path in namespaces])
+        self.bus.add_signal_receiver(
+            self.proxies.name_owner_changed,
+            dbus_interface='org.freedesktop.DBus',
+            signal_name='NameOwnerChanged')
+        self.signal_thread = threading.Thread(target=gobject.MainLoop().run,
+                                              name="DBusSignals")
+        self.signal_thread.daemon = True
+        self.signal_thread.start()
+
+    def add_signal_match(self, handler, interface, signal_name, rules,
+                         **keywords):
+        """Call handler for the signal of the objects selected by one of the
+        match rules, which dbus-daemon checks before sending the signal. The
+        receiver is added to the connection, add_signal_receiver of the bus
+        would also ask for the signal of every object on the bus"""
+        dbus.connection.Connection.add_signal_receiver(
+            self.bus, handler, signal_name=signal_name,
+            dbus_interface=interface, **keywords)
+        for rule in rules:
+            self.bus.add_match_string(
+                "type='signal',interface='%s',member='%s',%s" % (
+                    interface, signal_name, rule))
+
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        self.patch_object(str(path), changed, invalidated)
+
+    def interfaces_added(self, path, interfaces):
+        changed = {}
+        for properties in interfaces.values():
+            changed.update(properties)
+        self.patch_object(str(path), changed, [])
+
+    def interfaces_removed(self, path, interfaces):
+        """The properties of all interfaces of an object are merged in the
+        caches, drop the whole object"""
+        self.patch_object(str(path), {}, [], removed=True)
+
+    def patch_object(self, path, changed, invalidated, removed=False):
+        """Apply a change of one object to the cached inventory or sensors"""
+        try:
+            if path.startswith(INVENTORY_PATH):
+                self.patch_inventory(path, changed, invalidated, removed)
+            elif path.startswith(SENSORS_PATH):
+                values = to_native(changed)
+                self.sensor_sampler.patch(path.split('/')[-1], values,
+                                          invalidated, removed)
+        except Exception as e:
+            print e
+
+    def patch_inventory(self, path, changed, invalidated, removed=False):
+        """Update only the object at path in inventory_data, copying the
+        object so readers holding the old one are not affected"""
+        with self.inventory_lock:
+            if self.inventory_data is None:
+                return
+            if self.patched_paths is not None:
+                self.patched_paths.add(path)
+            if removed is True:
+                if self.inventory_data.pop(path, None) is None:
+                    return
+            else:
+                values = to_native(changed)
+                obj = dict(self.inventory_data.get(path, {}))
+                obj.update(values)
+                for key in invalidated:
+                    obj.pop(key, None)
+                self.inventory_data[path] = obj
+            self.inventory_generation += 1
+            self.schedule_notify(path)
+
+    def schedule_notify(self, path):
+        """Gather path for the listeners, the first patch of a burst starts a
+        timer calling them once for the whole burst. Call with
+        inventory_lock held"""
+        self.notify_paths.add(path)
+        if self.notify_timer is None:
+            self.notify_timer = threading.Timer(INVENTORY_NOTIFY_DELAY,
+                                                self.notify_patched)
+            self.notify_timer.name = "InventoryNotify"
+            self.notify_timer.daemon = True
+            self.notify_timer.start()
+
+    def notify_patched(self):
+        with self.inventory_lock:
+            paths = sorted(self.notify_paths)
+            self.notify_paths = set()
+            self.notify_timer = None
+        self.notify_inventory_listeners(paths)
+
+    def notify_inventory_listeners(self, paths):
+        for listener in self.inventory_listeners:
+            try:
+                listener(paths)
+            except Exception as e:
+                print e
 
     def find_sensor_value(self, name, object):
         merged = {}
@@ -107,41 +525,118 @@ class ObmcRedfishProviders(object):
                 return object[op]
 
     def get_enumerated_obj(self, path='/'):
-        sub_tree = self.mapper.get_subtree(path=path)
-        return {x: y for x, y in self.mapper.enumerate_subtree(
-                path, mapper_data=sub_tree).dataitems()}
+        start = time.time()
+        try:
+            sub_tree = self.mapper.get_subtree(path=path)
+            data = {x: y for x, y in self.mapper.enumerate_subtree(
+                    path, mapper_data=sub_tree).dataitems()}
+        except Exception:
+            observe_dbus_call('enumerate_subtree', start, failed=True)
+            raise
+        observe_dbus_call('enumerate_subtree', start)
+        return data
 
 
 # FIXME: FIX the return value argument
     def get_inventory(self, name):
-        if self.inventory_data is None:
+        """Returns the inventory objects of the fru_type name, key=path"""
+        index = self.get_inventory_index()
+        if index is None:
+            return "error"
+        return index.by_type.get(name, {})
+
+    def get_inventory_children(self, path):
+        """Returns the paths of the inventory objects under path"""
+        index = self.get_inventory_index()
+        if index is None:
+            return []
+        return index.children.get(path, [])
+
+    def get_inventory_index(self):
+        """Returns the InventoryIndex of the current inventory generation,
+        enumerating the inventory on first use. None on error"""
+        with self.inventory_lock:
+            if self.inventory_data is None and self.load_inventory() is False:
+                return None
+            index = self.inventory_index
+            if index is None or index.generation != self.inventory_generation:
+                index = InventoryIndex(self.inventory_data,
+                                       self.inventory_generation)
+                self.inventory_index = index
+        return index
+
+    def load_inventory(self):
+        """Load inventory_data from the snapshot and check it in the
+        background, or enumerate it and save a snapshot. Returns False on
+        error, call with inventory_lock held"""
+        if self.inventory_snapshot is not None:
+            data = self.inventory_snapshot.load()
+            if data is not None:
+                self.inventory_data = data
+                self.inventory_generation += 1
+                self.patched_paths = set()
+                self.snapshot_check_thread = threading.Thread(
+                    target=self.check_snapshot, name="InventorySnapshotCheck")
+                self.snapshot_check_thread.daemon = True
+                self.snapshot_check_thread.start()
+                return True
+        try:
+            data = self.get_enumerated_obj('org/openbmc/inventory')
+            self.inventory_data = to_native(data)
+            self.inventory_generation += 1
+        except Exception as e:
+            print e
+            return False
+        if self.inventory_snapshot is not None:
+            self.inventory_snapshot.save(self.inventory_data)
+        return True
+
+    def check_snapshot(self):
+        """Enumerate the inventory and apply the objects that differ from the
+        snapshot, except the ones patched by signals meanwhile which are
+        newer than the enumeration. A failed enumeration is tried again
+        after a backoff until one succeeds, the snapshot is served and
+        patched by the signals until then"""
+        retry_delay = SNAPSHOT_CHECK_RETRY_SECONDS
+        while True:
             try:
-                data = self.get_enumerated_obj('org/openbmc/inventory')
-                fix_byte(data, None, None)
-                self.inventory_data = json.loads(json.dumps(data))
+                fresh = to_native(
+                    self.get_enumerated_obj('org/openbmc/inventory'))
+                break
             except Exception as e:
-                print e
-                return "error"
-
-        inventory_object = self.find_inventory_object(name,
-                                                      self.inventory_data)
-        return inventory_object
+                print 'checking the inventory snapshot failed: %s, next ' \
+                    'try in %d s' % (e, retry_delay)
+                time.sleep(retry_delay)
+                retry_delay = min(SNAPSHOT_CHECK_RETRY_MAX_SECONDS,
+                                  retry_delay * 2)
+        with self.inventory_lock:
+            changed, removed = diff_inventory(self.inventory_data, fresh)
+            patched = self.patched_paths
+            self.patched_paths = None
+            paths = [path for path in changed.keys() + removed
+                     if path not in patched]
+            for path in paths:
+                if path in changed:
+                    self.inventory_data[path] = changed[path]
+                else:
+                    del self.inventory_data[path]
+            if len(paths):
+                self.inventory_generation += 1
+            if len(paths) or len(patched):
+                self.inventory_snapshot.save(self.inventory_data)
+        print "inventory snapshot checked, %d objects changed" % len(paths)
+        if len(paths):
+            self.notify_inventory_listeners(paths)
 
 # FIXME: Not all sensors are implemented in this, use nameserver!
-    def get_sensors(self, sensor):
+    def get_sensors(self, sensor, max_age=None):
+        """Returns the fields of the sensor from the sampler snapshot, pass
+        max_age to require readings taken in the last max_age seconds"""
         sensor_values = {}
         sensor_values['type'] = sensor
         try:
-            data = self.get_enumerated_obj('org/openbmc/sensors')
-            fix_byte(data, None, None)
-            pydata = json.loads(json.dumps(data))
-            s_value = self.find_sensor_value(SENSORS_INFO[sensor], pydata)
-            for item, values in s_value.items():
-                if(item == 'value' or
-                   item == 'units' or
-                   item == 'filename' or
-                   item == 'error'):
-                    sensor_values[item] = values
+            snapshot = self.get_sensor_snapshot(max_age)
+            sensor_values.update(snapshot.get(SENSORS_INFO[sensor]))
         except Exception as e:
             print e
 # FIXME: 'value' not found
@@ -149,24 +644,77 @@ class ObmcRedfishProviders(object):
 # del sensor_values['units']
         return sensor_values
 
+    def get_sensor_snapshot(self, max_age=None):
+        """Returns the SensorSnapshot of all the sensors"""
+        return self.sensor_sampler.get_snapshot(max_age)
+
     def get_system_type(self):
         """Refer to the Redfish Specification for available types"""
         return "Physical"
 
+    def call(self, bus_name, path, interface, method, *args):
+        """Call a D-Bus method through the proxy cache and wait for the
+        reply"""
+        start = time.time()
+        try:
+            mthd = self.proxies.get_method(bus_name, path, interface, method)
+            reply = mthd(*args)
+        except Exception as e:
+            observe_dbus_call(method, start, failed=True)
+            self.proxies.call_failed(bus_name, e)
+            raise
+        observe_dbus_call(method, start)
+        return reply
+
+    def call_async(self, bus_name, path, interface, method, args=(),
+                   convert=None):
+        """Issue a D-Bus method call from the D-Bus thread without waiting
+        for the reply, returns a DBusFuture of the reply"""
+        future = DBusFuture(convert)
+        issued = time.time()
+
+        def reply_handler(*reply):
+            observe_dbus_call(method, issued)
+            future.set_result(*reply)
+
+        def error_handler(error):
+            observe_dbus_call(method, issued, failed=True)
+            self.proxies.call_failed(bus_name, error)
+            future.set_error(error)
+
+        def start():
+            try:
+                mthd = self.proxies.get_method(bus_name, path, interface,
+                                               method)
+                mthd(*args, reply_handler=reply_handler,
+                     error_handler=error_handler)
+            except Exception as e:
+                error_handler(e)
+            return False
+
+        self.dispatch(start)
+        return future
+
+    def dispatch(self, function):
+        """Run the function on the D-Bus thread"""
+        gobject.idle_add(function)
+
     def get_system_state(self):
-        obj = self.bus.get_object('org.openbmc.managers.System',
-                                  '/org/openbmc/managers/System')
-        intf = dbus.Interface(obj, 'org.openbmc.managers.System')
-        mthd = obj.get_dbus_method('getSystemState',
-                                   'org.openbmc.managers.System')
         try:
-            data = mthd()
-            fix_byte(data, None, None)
-            pydata = json.loads(json.dumps(data))
-            return SYSTEM_STATES[pydata]
+            data = self.call('org.openbmc.managers.System',
+                             '/org/openbmc/managers/System',
+                             'org.openbmc.managers.System', 'getSystemState')
+            return SYSTEM_STATES[to_native(data)]
         except Exception as e:
             print e
 
+    def get_system_state_async(self):
+        return self.call_async('org.openbmc.managers.System',
+                               '/org/openbmc/managers/System',
+                               'org.openbmc.managers.System',
+                               'getSystemState',
+                               convert=lambda state: SYSTEM_STATES[state])
+
     def get_dimm_info(self):
         """Return a dictonary of DIMMs with fields set as per Redfish
         specification"""
@@ -223,10 +771,9 @@ class ObmcRedfishProviders(object):
             path_list = cpu.split("/")
             cpu_inst = path_list[-1].upper()
             info[cpu_inst] = {}
+            info[cpu_inst]["TotalCores"] = self.get_cpu_core_count(cpu)
             for key, value in detail.items():
                 value = str(value)
-                core_count = self.get_cpu_core_count(cpu_inst)
-                info[cpu_inst]["TotalCores"] = core_count
                 if key == 'Manufacturer':
                     info[cpu_inst]['Manufacturer'] = value
                 elif key == 'fru_type':
@@ -248,17 +795,18 @@ class ObmcRedfishProviders(object):
                                                          ("Health", "Ok")])
         return info
 
-    def get_cpu_core_count(self, cpu_id):
-        cores = []
-        item = self.get_inventory('CORE')
-        for core, info in item.items():
-            core_list = core.split("/")
-            core_id = core_list[-2].upper()
-            if core_id == cpu_id:
-                for key, value in info.items():
-                    if key == 'present' and value == 'True':
-                        cores.append('core')
-        return len(cores)
+    def get_cpu_core_count(self, cpu_path):
+        """Returns the number of present cores under the CPU object at
+        cpu_path"""
+        cores = self.get_inventory('CORE')
+        if cores == "error":
+            return 0
+        count = 0
+        for path in self.get_inventory_children(cpu_path):
+            core = cores.get(path)
+            if core is not None and core.get('present') == 'True':
+                count = count + 1
+        return count
 
     def get_bios_version(self):
         item = self.get_inventory('SYSTEM')
@@ -292,73 +840,77 @@ class ObmcRedfishProviders(object):
 
     def power_control(self, name):
         if name in POWER_CONTROL.keys():
-            method_name = POWER_CONTROL[name]
-            obj = self.bus.get_object('org.openbmc.control.Chassis',
-                                      '/org/openbmc/control/chassis0')
-            intf = dbus.Interface(obj, 'org.openbmc.control.Chassis')
-            mthd = obj.get_dbus_method(method_name,
-                                       'org.openbmc.control.Chassis')
-            out = mthd()
-            return out
+            return self.call('org.openbmc.control.Chassis',
+                             '/org/openbmc/control/chassis0',
+                             'org.openbmc.control.Chassis',
+                             POWER_CONTROL[name])
         else:
             print "Command %s not found" % name
 
     def get_system_id(self):
-        obj = self.bus.get_object('org.openbmc.control.Chassis',
-                                  '/org/openbmc/control/chassis0')
-        intf = dbus.Interface(obj, "org.freedesktop.DBus.Properties")
-        props = intf.GetAll('org.openbmc.control.Chassis')
+        props = self.call('org.openbmc.control.Chassis',
+                          '/org/openbmc/control/chassis0',
+                          'org.freedesktop.DBus.Properties', 'GetAll',
+                          'org.openbmc.control.Chassis')
         for p in props:
             if p == 'uuid':
                 return str(props[p])
 
     def led_operation(self, op, led_type):
         if led_type in LED_TYPE:
-            interface = '/org/openbmc/control/led/' + str(led_type)
-            obj = self.bus.get_object('org.openbmc.control.led',
-                                      interface)
-            intf = dbus.Interface(obj, 'org.openbmc.Led')
-            mthd = getattr(intf, LED_FUNCTIONS[op])
+            data = None
             try:
-                data = mthd()
+                data = self.call('org.openbmc.control.led',
+                                 '/org/openbmc/control/led/' + str(led_type),
+                                 'org.openbmc.Led', LED_FUNCTIONS[op])
             except Exception as e:
                 print e
-            if data is not None:
-                pydata = json.loads(json.dumps(data))
-                if (isinstance(pydata, list)):
-                    status = str(pydata[1])
-                    if status == 'On':
-                        return 'Lit'
-                    else:
-                        return 'Off'
+            return self.led_state(to_native(data))
+        else:
+            return None
+
+    def led_operation_async(self, op, led_type):
+        """led_operation issued as an asynchronous call, returns a DBusFuture
+        or None if there is no such led"""
+        if led_type in LED_TYPE:
+            return self.call_async('org.openbmc.control.led',
+                                   '/org/openbmc/control/led/' + led_type,
+                                   'org.openbmc.Led', LED_FUNCTIONS[op],
+                                   convert=self.led_state)
+        else:
+            return None
+
+    def led_state(self, pydata):
+        if pydata is not None:
+            if (isinstance(pydata, list)):
+                status = str(pydata[1])
+                if status == 'On':
+                    return 'Lit'
                 else:
-                    return pydata
+                    return 'Off'
             else:
-                return None
+                return pydata
         else:
             return None
 
 # Not working yet
     def get_host_settings(self):
-        obj = self.bus.get_object('org.openbmc.settings.Host',
-                                  '/org/openbmc/settings/host0')
-        intf = dbus.Interface(obj, 'org.freedesktop.Dbus.Properties')
-        data = intf.GetAll('org.openbmc.settings.Host')
-        fix_byte(data, None, None)
-        pydata = json.loads(json.dumps(data))
+        data = self.call('org.openbmc.settings.Host',
+                         '/org/openbmc/settings/host0',
+                         'org.freedesktop.Dbus.Properties', 'GetAll',
+                         'org.openbmc.settings.Host')
+        pydata = to_native(data)
         print pydata
 
     def set_max_fan_speed(self):
-        obj = self.bus.get_object('org.openbmc.control.Fans',
-                                  '/org/openbmc/control/fans')
-        intf = dbus.Interface(obj, 'org.openbmc.control.Fans')
-        data = intf.setMax()
+        data = self.call('org.openbmc.control.Fans',
+                         '/org/openbmc/control/fans',
+                         'org.openbmc.control.Fans', 'setMax')
 
     def get_fan_speed(self):
-        obj = self.bus.get_object('org.openbmc.control.Fans',
-                                  '/org/openbmc/control/fans')
-        intf = dbus.Interface(obj, "org.freedesktop.DBus.Properties")
-        data = intf.GetAll('org.openbmc.control.Fans')
-        fix_byte(data, None, None)
-        pydata = json.loads(json.dumps(data))
+        data = self.call('org.openbmc.control.Fans',
+                         '/org/openbmc/control/fans',
+                         'org.freedesktop.DBus.Properties', 'GetAll',
+                         'org.openbmc.control.Fans')
+        pydata = to_native(data)
         print pydata
@@ -0,0 +1,811 @@
+#! /usr/bin/env python
+
+# Description : Latency benchmark of the Redfish endpoints on a simulated
+#               provider, no system bus or hardware needed
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import threading
+import StringIO
+import httplib
+import dbus
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from obmc_redfish_providers import *
+from redfish_credential_cache import CredentialCache
+from redfish_metrics import METRICS, observe_dbus_call
+from redfish_eventer import Eventer
+from redfish_resource import RedfishBottleRoot, ODATA_ID
+from redfish_server import RedfishServer
+from redfish_test import get_paths
+
+BENCH_USER = 'root'
+BENCH_PASSWORD = '0penBmc'
+
+STARTUP_PATHS = ['/redfish/v1', '/redfish/v1/SessionService']
+"""Resources that must answer within the startup budget"""
+
+CHECK_DESTINATIONS = 8
+"""Destinations subscribed by the concurrency check, few enough that a POST
+of one already subscribed is frequent"""
+
+SIMULATED_UUID = '00000000-0000-0000-0000-000000000000'
+
+SIMULATED_REPLIES = {'getSystemState': (dbus.String('HOST_BOOTED'),),
+                     'GetLedState': (dbus.Struct((dbus.Int32(0),
+                                                  dbus.String('Off'))),),
+                     'GetAll': (dbus.Dictionary({
+                         dbus.String('uuid'): dbus.String(SIMULATED_UUID)}),)}
+"""Reply of the simulated D-Bus methods, other methods reply nothing"""
+
+
+class SimulatedObject(object):
+    """Proxy of an object on the simulated bus"""
+
+    def __init__(self, provider, bus_name, path):
+        self.provider = provider
+        self.bus_name = bus_name
+        self.path = path
+
+    def get_dbus_method(self, method, interface=None):
+        provider = self.provider
+        reply = SIMULATED_REPLIES.get(method, ())
+
+        def call(*args, **kw):
+            reply_handler = kw.get('reply_handler')
+            if reply_handler is None:
+                provider.bus_call(method)
+                if len(reply) == 0:
+                    return None
+                return reply[0]
+
+            def reply_later():
+                provider.bus_call(method)
+                reply_handler(*reply)
+
+            if provider.latency > 0:
+                thread = threading.Thread(target=reply_later)
+                thread.daemon = True
+                thread.start()
+            else:
+                reply_later()
+
+        return call
+
+
+class SimulatedBus(object):
+    """System bus of the simulated provider. Making a proxy takes the round
+    trips dbus-python makes: the bus name is resolved to its owner and the
+    object is introspected unless asked not to"""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def get_object(self, bus_name, path, introspect=True,
+                   follow_name_owner_changes=False):
+        if follow_name_owner_changes is False:
+            self.provider.bus_call('GetNameOwner')
+        if introspect is True:
+            self.provider.bus_call('Introspect')
+        return SimulatedObject(self.provider, bus_name, path)
+
+
+class SimulatedProviders(ObmcRedfishProviders):
+    """
+    ObmcRedfishProviders with the system bus replaced by a synthetic
+    inventory, sensors and method replies. Every simulated D-Bus round trip
+    takes latency seconds. The method calls go through the proxy cache and
+    the parsing of the replies of the real provider
+    """
+
+    def __init__(self, cpus=2, cores=12, dimms=16, pcie=4, latency=0.0,
+                 sensor_interval=SENSOR_SAMPLE_INTERVAL, snapshot_path=None):
+        self.cpus = cpus
+        self.cores = cores
+        self.dimms = dimms
+        self.pcie = pcie
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.messages = 0
+        """Round trips on the simulated bus, except the ones of the sensor
+        sampler"""
+
+        self.bus = SimulatedBus(self)
+        self.init_state(sensor_interval, snapshot_path)
+
+    def bus_call(self, method):
+        """One round trip on the simulated bus"""
+        if threading.current_thread() is not self.sensor_sampler:
+            with self.lock:
+                self.messages += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def make_inventory(self):
+        board = INVENTORY_PATH + '/system/chassis/motherboard'
+        data = dbus.Dictionary()
+        data[dbus.ObjectPath(INVENTORY_PATH + '/system')] = dbus.Dictionary({
+            dbus.String('fru_type'): dbus.String('SYSTEM'),
+            dbus.String('present'): dbus.String('True'),
+            dbus.String('Version'): dbus.String('simulated')})
+        data[dbus.ObjectPath(board + '/membuf0')] = dbus.Dictionary({
+            dbus.String('fru_type'): dbus.String('MEMORY_BUFFER'),
+            dbus.String('present'): dbus.String('True'),
+            dbus.String('Custom Field 1'): dbus.String(SIMULATED_UUID),
+            dbus.String('Manufacturer'): dbus.String('Simulated'),
+            dbus.String('Name'): dbus.String('Simulated Chassis'),
+            dbus.String('Part Number'): dbus.String('PN-CHASSIS'),
+            dbus.String('Serial Number'): dbus.String('0000000000000000')})
+        for cpu in range(0, self.cpus):
+            path = board + '/cpu%d' % cpu
+            data[dbus.ObjectPath(path)] = dbus.Dictionary({
+                dbus.String('fru_type'): dbus.String('CPU'),
+                dbus.String('present'): dbus.String('True'),
+                dbus.String('Manufacturer'): dbus.String('Simulated'),
+                dbus.String('Serial Number'): dbus.String('SN-CPU%d' % cpu),
+                dbus.String('Part Number'): dbus.String('PN-CPU'),
+                dbus.String('Name'): dbus.String('Simulated CPU'),
+                dbus.String('Custom Field 2'): dbus.String(
+                    'UUID:' + SIMULATED_UUID)})
+            for core in range(0, self.cores):
+                data[dbus.ObjectPath(path + '/core%d' % core)] = \
+                    dbus.Dictionary({
+                        dbus.String('fru_type'): dbus.String('CORE'),
+                        dbus.String('present'): dbus.String('True')})
+        for dimm in range(0, self.dimms):
+            data[dbus.ObjectPath(board + '/dimm%d' % dimm)] = \
+                dbus.Dictionary({
+                    dbus.String('fru_type'): dbus.String('DIMM'),
+                    dbus.String('present'): dbus.String('True'),
+                    dbus.String('Manufacturer'): dbus.String('Simulated'),
+                    dbus.String('Serial Number'): dbus.String(
+                        'SN-DIMM%d' % dimm),
+                    dbus.String('Part Number'): dbus.String('PN-DIMM'),
+                    dbus.String('Name'): dbus.String('Simulated DIMM')})
+        for slot in range(0, self.pcie):
+            data[dbus.ObjectPath(board + '/pcieslot%d' % slot)] = \
+                dbus.Dictionary({
+                    dbus.String('fru_type'): dbus.String('PCIE_CARD'),
+                    dbus.String('present'): dbus.String('True')})
+        return data
+
+    def make_sensors(self):
+        data = dbus.Dictionary()
+        for name in SENSORS_INFO.values():
+            data[dbus.ObjectPath(SENSORS_PATH + '/host/' + name)] = \
+                dbus.Dictionary({
+                    dbus.String('value'): dbus.Int32(0),
+                    dbus.String('units'): dbus.String(''),
+                    dbus.String('error'): dbus.Boolean(False)})
+        return data
+
+    def get_enumerated_obj(self, path='/'):
+        """The subtree is looked up, then the properties of every object are
+        read, one round trip each"""
+        start = time.time()
+        self.bus_call('GetSubTree')
+        data = dbus.Dictionary()
+        if path.strip('/') == INVENTORY_PATH.strip('/'):
+            data = self.make_inventory()
+        elif path.strip('/') == SENSORS_PATH.strip('/'):
+            data = self.make_sensors()
+        for _ in data:
+            self.bus_call('GetAll')
+        observe_dbus_call('enumerate_subtree', start)
+        return data
+
+    def dispatch(self, function):
+        """There is no D-Bus thread, run the function right away"""
+        function()
+
+
+class WsgiClient(object):
+    """Calls a WSGI application in process"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body='', headers={}):
+        """Returns the status code, the headers and the body"""
+        environ = {'REQUEST_METHOD': method,
+                   'SCRIPT_NAME': '',
+                   'PATH_INFO': path,
+                   'QUERY_STRING': '',
+                   'SERVER_NAME': 'localhost',
+                   'SERVER_PORT': '8080',
+                   'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'REMOTE_ADDR': '127.0.0.1',
+                   'CONTENT_TYPE': 'application/json',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': StringIO.StringIO(body),
+                   'wsgi.errors': sys.stderr,
+                   'wsgi.url_scheme': 'http',
+                   'wsgi.version': (1, 0),
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': False,
+                   'wsgi.run_once': False}
+        if '?' in path:
+            environ['PATH_INFO'], environ['QUERY_STRING'] = path.split('?', 1)
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict(response_headers)
+
+        data = ''.join(self.app(environ, start_response))
+        return response['status'], response['headers'], data
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpClient(object):
+    """Sends the requests over HTTP on the loopback interface to a server
+    running the WSGI application on a thread of its own"""
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app,
+                                  handler_class=QuietRequestHandler)
+        self.port = self.server.server_address[1]
+        thr = threading.Thread(target=self.server.serve_forever,
+                               name="BenchHttpServer")
+        thr.daemon = True
+        thr.start()
+
+    def request(self, method, path, body='', headers={}):
+        """Returns the status code, the headers and the body"""
+        connection = httplib.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return (response.status, dict(response.getheaders()),
+                    response.read())
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Endpoint(object):
+    """One benchmarked request, the latencies are in seconds"""
+
+    def __init__(self, name, method, path, body=''):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.latencies = []
+        self.statuses = {}
+        self.torn = 0
+        """Responses that should be json and could not be parsed"""
+        self.lock = threading.Lock()
+
+    def run(self, client):
+        start = time.time()
+        status, headers, data = client.request(self.method, self.path,
+                                               self.body)
+        elapsed = time.time() - start
+        torn = False
+        if status == 200 and headers.get('Content-Type', '').startswith(
+                'application/json'):
+            try:
+                json.loads(data)
+            except ValueError:
+                torn = True
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if torn is True:
+                self.torn += 1
+        return status, data
+
+    def get_stats(self, wall):
+        latencies = sorted(self.latencies)
+        return {'requests': len(latencies),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'throughput': len(latencies) / wall if wall > 0 else 0,
+                'statuses': dict((str(k), v) for k, v in
+                                 self.statuses.items()),
+                'torn': self.torn}
+
+
+class SessionCycle(object):
+    """Login followed by logout, measured as two endpoints"""
+
+    def __init__(self):
+        self.login = Endpoint('POST Sessions', 'POST',
+                              '/redfish/v1/SessionService/Sessions',
+                              json.dumps({'UserName': BENCH_USER,
+                                          'Password': BENCH_PASSWORD}))
+        self.logout = Endpoint('DELETE Session', 'DELETE', None)
+
+    def run(self, client):
+        status, data = self.login.run(client)
+        try:
+            self.logout.path = json.loads(data)['Location']
+        except (ValueError, KeyError):
+            return
+        self.logout.run(client)
+
+
+class ConcurrencyCheck(object):
+    """
+    Threads sending a random mix of GET, POST and DELETE requests to the
+    sessions and the event subscriptions. After every response the response
+    and the collections are checked: the Members of a collection, its
+    children and the path index must agree, and a collection sent must count
+    its Members. The session store and the eventer are checked against the
+    collections once the threads are done
+    """
+
+    def __init__(self, root, client, seed=0):
+        self.root = root
+        self.client = client
+        self.seed = seed
+        self.collections = [root.session_collection,
+                            root.event_destination_collection]
+        self.lock = threading.Lock()
+        self.statuses = {}
+        """Responses by method and status"""
+        self.errors = []
+
+    def run(self, threads, requests):
+        """Sends requests from each of threads, returns the errors found"""
+        workers = [threading.Thread(target=self.work,
+                                    args=(random.Random(self.seed + i),
+                                          requests))
+                   for i in range(0, threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.errors.extend(self.final_errors())
+        return self.errors
+
+    def work(self, rnd, requests):
+        for _ in range(0, requests):
+            method, path, body = self.pick(rnd)
+            status, headers, data = self.client.request(method, path, body)
+            errors = self.response_errors(method, path, status, data)
+            for collection in self.collections:
+                errors.extend(collection_errors(collection))
+            with self.lock:
+                key = "%s %d" % (method, status)
+                self.statuses[key] = self.statuses.get(key, 0) + 1
+                self.errors.extend("%s %s: %s" % (method, path, error)
+                                   for error in errors)
+
+    def pick(self, rnd):
+        """Returns the method, path and body of a random request"""
+        collection = rnd.choice(self.collections)
+        method = rnd.choice(['GET', 'GET', 'POST', 'DELETE'])
+        if method == 'POST':
+            if collection is self.root.session_collection:
+                body = {'UserName': BENCH_USER, 'Password': BENCH_PASSWORD}
+            else:
+                body = {'Destination': 'http://127.0.0.1/events/%d' %
+                        rnd.randrange(0, CHECK_DESTINATIONS),
+                        'Context': 'check'}
+            return method, collection.path, json.dumps(body)
+        members = collection.get_children()
+        if method == 'GET' and (len(members) == 0 or rnd.random() < 0.5):
+            return method, collection.path, ''
+        name = str(rnd.randrange(0, 100))
+        if len(members):
+            name = rnd.choice(members).name
+        return method, collection.path + '/' + name, ''
+
+    def response_errors(self, method, path, status, data):
+        """Returns what is wrong with one response, the resources it names
+        may be gone by now so only the response itself is checked"""
+        if status >= 500:
+            return ["status %d" % status]
+        if status != 200 or len(data) == 0:
+            return []
+        try:
+            document = json.loads(data)
+        except ValueError:
+            return ["torn response"]
+        if method != 'GET' or "Members" not in document:
+            return []
+        members = [m[ODATA_ID] for m in document["Members"]]
+        errors = []
+        if document["Members@odata.count"] != len(members):
+            errors.append("Members@odata.count %d, %d Members" % (
+                document["Members@odata.count"], len(members)))
+        if len(set(members)) != len(members):
+            errors.append("Members repeated")
+        return errors
+
+    def final_errors(self):
+        """Returns the differences between the collections and the session
+        store and the eventer they front"""
+        errors = []
+        sessions = self.root.session_collection
+        with sessions.lock:
+            names = set(c.name for c in sessions.child)
+            store = set(str(i) for i in sessions.store.sessions.keys())
+        if names != store:
+            errors.append("sessions %s, session store %s" % (
+                sorted(names), sorted(store)))
+        subscriptions = self.root.event_destination_collection
+        with subscriptions.lock:
+            destinations = [c.destination for c in subscriptions.child]
+            subscribed = self.root.eventer.client_URI_endpoints.keys()
+        if sorted(destinations) != sorted(subscribed):
+            errors.append("subscriptions %s, eventer %s" % (
+                sorted(destinations), sorted(subscribed)))
+        return errors
+
+
+def collection_errors(collection):
+    """Returns the differences between the Members of the collection, its
+    children and the path index, checked with the lock of the collection
+    held"""
+    errors = []
+    path_index = collection.path_index
+    prefix = collection.path + '/'
+    with collection.lock:
+        children = list(collection.child)
+        paths = set(c.path for c in children)
+        if (len(collection.child_index) != len(children) or
+                any(collection.child_index.get(c.name) is not c
+                    for c in children)):
+            errors.append("child index differs from the children")
+        count = collection.attrs["Members@odata.count"]
+        if count != len(children):
+            errors.append("Members@odata.count %d, %d children" % (
+                count, len(children)))
+        if "Members" in collection.attrs:
+            members = [m[ODATA_ID] for m in collection.attrs["Members"]]
+            if len(members) != len(children) or set(members) != paths:
+                errors.append("Members %s, children %s" % (
+                    sorted(members), sorted(paths)))
+        with path_index.lock:
+            indexed = set(key for key in dict.keys(path_index)
+                          if key.startswith(prefix) and
+                          '/' not in key[len(prefix):])
+        if indexed != paths or any(path_index.get(c.path) is not c
+                                   for c in children):
+            errors.append("path index %s, children %s" % (
+                sorted(indexed), sorted(paths)))
+    return errors
+
+
+def check_concurrency(args):
+    """Runs the ConcurrencyCheck on a tree of the simulated provider with an
+    eventer journaling to a temporary directory. Returns True if an error
+    was found"""
+    directory = tempfile.mkdtemp()
+    eventer = Eventer(False, 3, 5,
+                      journal_path=os.path.join(directory, 'journal'),
+                      subscriptions_path=os.path.join(directory, 'json'))
+    try:
+        provider = SimulatedProviders(args.cpus, args.cores, args.dimms,
+                                      args.pcie, args.latency_ms / 1000.0)
+        root = RedfishBottleRoot(provider, lazy=False, eventer=eventer)
+        root.session_collection.credentials = bench_credentials()
+        check = ConcurrencyCheck(root, WsgiClient(RedfishServer(root)))
+        start = time.time()
+        errors = check.run(args.threads, args.requests)
+        wall = time.time() - start
+    finally:
+        while eventer.journal.compacting is True:
+            time.sleep(0.01)
+        eventer.journal.close()
+        shutil.rmtree(directory)
+    print "%d requests on %d threads in %.1f ms" % (
+        args.threads * args.requests, args.threads, wall * 1000)
+    for key in sorted(check.statuses.keys()):
+        print "%-12s %6d" % (key, check.statuses[key])
+    for error in errors[:20]:
+        print error
+    if len(errors):
+        print "%d inconsistencies found" % len(errors)
+    return len(errors) > 0
+
+
+def bench_credentials():
+    """Credentials of the benchmark user, checked without the shadow file"""
+    return CredentialCache(
+        verify=lambda username, clear: (username == BENCH_USER and
+                                        clear == BENCH_PASSWORD))
+
+
+def percentile(values, p):
+    """Nearest rank percentile of the sorted values"""
+    if len(values) == 0:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def make_endpoints(root):
+    endpoints = [Endpoint('GET /' + path, 'GET', '/' + path)
+                 for path in get_paths]
+    endpoints.append(Endpoint('GET /redfish/v1/$metadata', 'GET',
+                              '/redfish/v1/$metadata'))
+    system = root.system.path
+    chassis = root.chassis.path
+    endpoints.append(Endpoint(
+        'POST ComputerSystem.Reset', 'POST',
+        system + '/Actions/ComputerSystem.Reset',
+        json.dumps({'ResetType': 'On'})))
+    endpoints.append(Endpoint(
+        'POST ComputerSystem.LedUpdate', 'POST',
+        system + '/Actions/ComputerSystem.LedUpdate',
+        json.dumps({'LedUpdateType': 'Off'})))
+    endpoints.append(Endpoint(
+        'POST Chassis.LedUpdate', 'POST',
+        chassis + '/Actions/Chassis.LedUpdate',
+        json.dumps({'LedUpdateType': 'Off'})))
+    return endpoints
+
+
+def run_benchmark(client, endpoints, sessions, requests, threads,
+                  provider=None):
+    """Runs every endpoint requests times, spread over threads running at the
+    same time. Returns the stats of the endpoints by name, with the bus
+    messages per request if the simulated provider is passed"""
+    runners = [(e.name, e.run) for e in endpoints]
+    runners.append((sessions.login.name, sessions.run))
+    results = {}
+    for name, runner in runners:
+        def work(count):
+            for _ in range(0, count):
+                runner(client)
+
+        counts = [requests // threads + (1 if i < requests % threads else 0)
+                  for i in range(0, threads)]
+        workers = [threading.Thread(target=work, args=(count,))
+                   for count in counts]
+        messages = provider.messages if provider is not None else 0
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall = time.time() - start
+        if runner == sessions.run:
+            results[sessions.login.name] = sessions.login.get_stats(wall)
+            results[sessions.logout.name] = sessions.logout.get_stats(wall)
+        else:
+            results[name] = [e for e in endpoints
+                             if e.name == name][0].get_stats(wall)
+        if provider is not None and requests > 0:
+            results[name]['messages'] = (
+                float(provider.messages - messages) / requests)
+    return results
+
+
+def measure_startup(args, lazy, snapshot_path=None):
+    """Returns the seconds from the construction of the tree to the first
+    response of every STARTUP_PATHS, and to the whole tree being built"""
+    provider = SimulatedProviders(args.cpus, args.cores, args.dimms,
+                                  args.pcie, args.latency_ms / 1000.0,
+                                  snapshot_path=snapshot_path)
+    provider.sensor_sampler.refresh()
+    start = time.time()
+    root = RedfishBottleRoot(provider, lazy=lazy)
+    client = WsgiClient(RedfishServer(root))
+    first = {}
+    for path in STARTUP_PATHS:
+        status, headers, data = client.request('GET', path)
+        first[path] = time.time() - start
+    root.startup.wait()
+    built = time.time() - start
+    if provider.snapshot_check_thread is not None:
+        provider.snapshot_check_thread.join()
+    return first, built
+
+
+def print_startup(args):
+    """Prints the startup times of the lazy and the eager tree, and of the
+    lazy tree served from the inventory snapshot of a previous start.
+    Returns True if a first response of a lazy tree took longer than the
+    budget"""
+    over_budget = False
+    directory = tempfile.mkdtemp()
+    snapshot_path = os.path.join(directory, 'inventory.snapshot.json')
+    try:
+        SimulatedProviders(args.cpus, args.cores, args.dimms, args.pcie,
+                           snapshot_path=snapshot_path).get_inventory_index()
+        for name, lazy, path in (('lazy', True, None),
+                                 ('eager', False, None),
+                                 ('warm', True, snapshot_path)):
+            first, built = measure_startup(args, lazy, path)
+            line = "startup %-5s" % name
+            for path in STARTUP_PATHS:
+                line += "  %s %8.1f ms" % (path, first[path] * 1000)
+                if (lazy is True and
+                        first[path] * 1000 > args.startup_budget_ms):
+                    over_budget = True
+            print line + "  tree built %8.1f ms" % (built * 1000)
+    finally:
+        shutil.rmtree(directory)
+    if over_budget is True:
+        print "first response over the budget of %.1f ms" % (
+            args.startup_budget_ms)
+    return over_budget
+
+
+def measure_metrics_overhead(client, paths, rounds):
+    """Returns the median seconds per GET of the paths with the metrics
+    recorded and without, and the 25th, 50th and 75th percentiles of the
+    overhead in %. Rounds with and without alternate, and every two rounds
+    run in both orders so the drift of the host cancels out"""
+    def run(enabled):
+        METRICS.enabled = enabled
+        start = time.time()
+        for path in paths:
+            client.request('GET', path)
+        return time.time() - start
+
+    enabled = METRICS.enabled
+    times = {True: [], False: []}
+    ratios = []
+    try:
+        run(True)
+        run(False)
+        for i in range(0, rounds):
+            order = (True, False) if i % 2 == 0 else (False, True)
+            elapsed = dict((recorded, run(recorded)) for recorded in order)
+            for recorded in order:
+                times[recorded].append(elapsed[recorded])
+            ratios.append(elapsed[True] / elapsed[False])
+    finally:
+        METRICS.enabled = enabled
+    pairs = sorted(math.sqrt(ratios[i] * ratios[i + 1])
+                   for i in range(0, len(ratios) - 1, 2))
+    return (percentile(sorted(times[True]), 50) / len(paths),
+            percentile(sorted(times[False]), 50) / len(paths),
+            [(percentile(pairs, p) - 1) * 100 for p in (25, 50, 75)])
+
+
+def print_metrics_overhead(args):
+    """Prints the cost of recording the metrics on the GET endpoints, in
+    process and over HTTP on the loopback interface"""
+    provider = SimulatedProviders(args.cpus, args.cores, args.dimms,
+                                  args.pcie, args.latency_ms / 1000.0)
+    root = RedfishBottleRoot(provider, lazy=False)
+    app = RedfishServer(root)
+    client = WsgiClient(app)
+    paths = [e.path for e in make_endpoints(root) if e.method == 'GET' and
+             client.request('GET', e.path)[0] == 200]
+    http = HttpClient(app)
+    try:
+        for name, bench_client in (('in process', client),
+                                   ('over HTTP', http)):
+            recorded, unrecorded, overhead = measure_metrics_overhead(
+                bench_client, paths, args.requests)
+            print ("metrics %-10s  GET %8.1f us, recorded %5.2f us, "
+                   "overhead %+5.2f%% (quartiles %+5.2f%% %+5.2f%%)" % (
+                       name, unrecorded * 1e6, (recorded - unrecorded) * 1e6,
+                       overhead[1], overhead[0], overhead[2]))
+    finally:
+        http.close()
+
+
+def print_results(results, baseline=None, tolerance=10.0):
+    """Prints the stats, and their change from the baseline. Returns the
+    names of the endpoints whose p50 or p99 grew more than tolerance %"""
+    regressions = []
+    print "%-58s %7s %9s %9s %9s %6s" % ('endpoint', 'status', 'p50 ms',
+                                         'p99 ms', 'req/s', 'msgs')
+    for name in sorted(results.keys()):
+        stats = results[name]
+        statuses = ','.join(sorted(stats['statuses'].keys()))
+        line = "%-58s %7s %9.3f %9.3f %9.1f %6.1f" % (
+            name, statuses, stats['p50_ms'], stats['p99_ms'],
+            stats['throughput'], stats.get('messages', 0.0))
+        if stats['torn'] > 0:
+            line += "  %d torn" % stats['torn']
+        if baseline is not None and name in baseline:
+            changes = []
+            for key in ('p50_ms', 'p99_ms'):
+                before = baseline[name][key]
+                change = 0.0
+                if before > 0:
+                    change = (stats[key] - before) * 100.0 / before
+                changes.append(change)
+            line += "  p50 %+6.1f%% p99 %+6.1f%%" % tuple(changes)
+            if max(changes) > tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print line
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Latency of the Redfish endpoints on simulated hardware")
+    parser.add_argument('--cpus', type=int, default=2)
+    parser.add_argument('--cores', type=int, default=12,
+                        help="cores per CPU")
+    parser.add_argument('--dimms', type=int, default=16)
+    parser.add_argument('--pcie', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="time taken by every simulated D-Bus call")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per endpoint")
+    parser.add_argument('--warmup', type=int, default=5,
+                        help="requests per endpoint before measuring")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="clients sending the requests of an endpoint "
+                        "at the same time")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="switch off the recording of metrics")
+    parser.add_argument('--no-proxy-cache', action='store_true',
+                        help="make an introspected D-Bus proxy for every "
+                        "call")
+    parser.add_argument('--startup', action='store_true',
+                        help="measure the time to the first responses after "
+                        "the tree is made, lazy and eager, and exit")
+    parser.add_argument('--startup-budget-ms', type=float, default=100.0,
+                        help="time allowed to the first responses of the "
+                        "lazy tree")
+    parser.add_argument('--check-concurrency', action='store_true',
+                        help="send a mix of GET, POST and DELETE requests on "
+                        "the sessions and the subscriptions from --threads "
+                        "threads, --requests each, check the collections "
+                        "after every response and exit")
+    parser.add_argument('--metrics-overhead', action='store_true',
+                        help="measure the cost of recording the metrics on "
+                        "the GET endpoints, --requests rounds with and "
+                        "without in turn, and exit")
+    parser.add_argument('--save', help="file to save the results to")
+    parser.add_argument('--compare', help="baseline file saved by --save")
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help="%% of p50 or p99 growth reported as regression")
+    args = parser.parse_args()
+    METRICS.enabled = not args.no_metrics
+    if args.startup is True:
+        sys.exit(1 if print_startup(args) is True else 0)
+    if args.check_concurrency is True:
+        sys.exit(1 if check_concurrency(args) is True else 0)
+    if args.metrics_overhead is True:
+        print_metrics_overhead(args)
+        sys.exit(0)
+
+    provider = SimulatedProviders(args.cpus, args.cores, args.dimms,
+                                  args.pcie, args.latency_ms / 1000.0)
+    provider.proxies.enabled = not args.no_proxy_cache
+    start = time.time()
+    root = RedfishBottleRoot(provider, lazy=False)
+    print "tree built in %.1f ms" % ((time.time() - start) * 1000)
+    root.session_collection.credentials = bench_credentials()
+    client = WsgiClient(RedfishServer(root))
+
+    if args.warmup > 0:
+        run_benchmark(client, make_endpoints(root), SessionCycle(),
+                      args.warmup, 1)
+    results = run_benchmark(client, make_endpoints(root), SessionCycle(),
+                            args.requests, args.threads, provider)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = print_results(results, baseline, args.tolerance)
+    if args.save is not None:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=1, sort_keys=True)
+    torn = sum(stats['torn'] for stats in results.values())
+    if torn > 0:
+        print "%d torn responses" % torn
+    if len(regressions) or torn > 0:
+        sys.exit(1)
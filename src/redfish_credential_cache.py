@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+
+# Description : Cache of verified credentials for the login of sessions
+
+import os
+import hmac
+import time
+import spwd
+import crypt
+import hashlib
+import threading
+import collections
+
+SHADOW_FILE = '/etc/shadow'
+
+CREDENTIAL_TTL_SECONDS = 300
+"""Time a verified password is trusted without running crypt again"""
+
+FAILURE_TTL_SECONDS = 30
+"""Time a wrong password is answered from the cache"""
+
+MAX_CACHED_CREDENTIALS = 128
+
+MAX_FAILURES = 5
+FAILURE_WINDOW_SECONDS = 60
+"""A user with MAX_FAILURES failed logins within the window is refused
+until the oldest failure leaves the window"""
+
+MAX_TRACKED_USERS = 256
+"""Users whose failed logins are counted, the failures of the other users
+are counted together"""
+
+OTHER_USERS = None
+"""Key of the failures of the users that found MAX_TRACKED_USERS tracked"""
+
+
+def verify_shadow(username, clear):
+    """Checks the password against the shadow file, one full crypt"""
+    try:
+        encoded = spwd.getspnam(username)[1]
+        return encoded == crypt.crypt(clear, encoded)
+    except KeyError:
+        return False
+
+
+class CredentialCache(object):
+    """
+    Results of password checks keyed by an HMAC of the username and the
+    password, the key of the HMAC is drawn at start and never leaves the
+    process. Entries expire after a ttl, the least recently used is dropped
+    when the cache is full and all of them are dropped when the shadow file
+    changes. Failed logins of a user are counted, cached or not, and the
+    user is refused without a check once they are too many. A user stays
+    tracked until its failures leave the window, so failing logins of other
+    users can not make the tracker forget it. Once max_tracked_users are
+    tracked, the failures of the users that are not are counted together and
+    refuse all of them
+    """
+
+    def __init__(self, verify=verify_shadow, shadow_file=SHADOW_FILE,
+                 ttl=CREDENTIAL_TTL_SECONDS,
+                 failure_ttl=FAILURE_TTL_SECONDS,
+                 max_entries=MAX_CACHED_CREDENTIALS,
+                 max_failures=MAX_FAILURES,
+                 failure_window=FAILURE_WINDOW_SECONDS,
+                 max_tracked_users=MAX_TRACKED_USERS, clock=time.time):
+        self.verify = verify
+        self.shadow_file = shadow_file
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.max_tracked_users = max_tracked_users
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.secret = os.urandom(32)
+        self.entries = collections.OrderedDict()
+        """key = HMAC of the credentials, value = result and expiry time,
+        least recently used first"""
+        self.failures = {}
+        """key = username or OTHER_USERS, value = deque of the times of
+        failed logins"""
+        self.shadow_stat = self.stat_shadow()
+
+    def stat_shadow(self):
+        try:
+            st = os.stat(self.shadow_file)
+            return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+        except OSError:
+            return None
+
+    def key_of(self, username, clear):
+        message = (username + u'\0' + clear).encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def blocked(self, username, now):
+        """Returns True if the user failed too often lately, or is not tracked
+        and the users that are not did. Call with the lock held"""
+        if username not in self.failures:
+            username = OTHER_USERS
+        return self.recent_failures(username, now) >= self.max_failures
+
+    def recent_failures(self, key, now):
+        """Returns the number of failures of key within the window, the older
+        ones are dropped. Call with the lock held"""
+        times = self.failures.get(key)
+        if times is None:
+            return 0
+        while len(times) and times[0] <= now - self.failure_window:
+            times.popleft()
+        if len(times) == 0:
+            del self.failures[key]
+        return len(times)
+
+    def record_failure(self, username, now):
+        with self.lock:
+            if username not in self.failures:
+                for key in self.failures.keys():
+                    self.recent_failures(key, now)
+                tracked = len(self.failures) - (OTHER_USERS in self.failures)
+                if tracked >= self.max_tracked_users:
+                    username = OTHER_USERS
+            times = self.failures.get(username)
+            if times is None:
+                times = collections.deque(maxlen=self.max_failures)
+                self.failures[username] = times
+            times.append(now)
+
+    def lookup(self, key, now):
+        """Returns the cached result of the credentials or None, call with
+        the lock held"""
+        shadow_stat = self.stat_shadow()
+        if shadow_stat != self.shadow_stat:
+            self.entries.clear()
+            self.shadow_stat = shadow_stat
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[1] <= now:
+            return None
+        self.entries[key] = entry
+        return entry[0]
+
+    def store(self, key, result, now, shadow_stat):
+        ttl = self.ttl if result is True else self.failure_ttl
+        with self.lock:
+            if shadow_stat != self.shadow_stat:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (result, now + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def authenticate(self, username, clear):
+        """Returns True if the password of the user is right"""
+        now = self.clock()
+        key = self.key_of(username, clear)
+        with self.lock:
+            if self.blocked(username, now):
+                print "login of %s refused after repeated failures" % username
+                return False
+            result = self.lookup(key, now)
+            shadow_stat = self.shadow_stat
+        if result is None:
+            result = self.verify(username, clear)
+            self.store(key, result, now, shadow_stat)
+        if result is True:
+            with self.lock:
+                self.failures.pop(username, None)
+        else:
+            self.record_failure(username, now)
+        return result
+
+
+if __name__ == '__main__':
+    runs = 200
+    encoded = crypt.crypt('0penBmc', '$6$' + os.urandom(6).encode('hex'))
+    checks = []
+
+    def verify(username, clear):
+        checks.append(username)
+        return encoded == crypt.crypt(clear, encoded)
+
+    cache = CredentialCache(verify=verify)
+    start = time.time()
+    for _ in range(0, runs):
+        encoded == crypt.crypt('0penBmc', encoded)
+    print "crypt of a SHA-512 hash  : %.3f ms" % (
+        (time.time() - start) * 1000 / runs)
+    cache.authenticate('root', '0penBmc')
+    start = time.time()
+    for _ in range(0, runs):
+        cache.authenticate('root', '0penBmc')
+    print "cached authenticate      : %.3f ms" % (
+        (time.time() - start) * 1000 / runs)
+    del checks[:]
+    results = [cache.authenticate('root', 'guess%d' % i) for i in range(10)]
+    print "10 wrong guesses         : %d accepted, %d checked" % (
+        results.count(True), len(checks))
+    print "right password, blocked  : %s" % cache.authenticate('root',
+                                                               '0penBmc')
+    cache = CredentialCache(verify=verify, max_tracked_users=8)
+    for i in range(0, MAX_FAILURES - 1):
+        cache.authenticate('root', 'guess%d' % i)
+    for i in range(0, 12):
+        cache.authenticate('user%d' % i, 'guess')
+    print "failures of root kept after 12 users failed : %d" % len(
+        cache.failures['root'])
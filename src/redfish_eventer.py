@@ -3,20 +3,52 @@
 # Description : Eventer for OpenBMC Redfish
 
 import json
-import urllib2
+import errno
+import heapq
+import random
+import collections
+import httplib
+import urlparse
+import socket
 import time
 import Queue
 import threading
 import datetime
 import os
+from redfish_subscription_journal import SubscriptionJournal
+from redfish_metrics import count, observe, EVENT_DELIVERIES
+from redfish_metrics import EVENT_DELIVERY_SECONDS
 
 """
 Redfish Eventing Persistent Static Storage File Path
 """
 TMP_MEM_PATH = '/var/tmp/'
 TMP_MEM_FILENAME = 'subscriptions.json'
+JOURNAL_FILENAME = 'subscriptions.journal'
 
 SUBSCRIPTIONS_FP = os.path.join(TMP_MEM_PATH, TMP_MEM_FILENAME)
+"""Subscriptions file written before the journal, read once to migrate"""
+
+SUBSCRIPTIONS_JOURNAL_FP = os.path.join(TMP_MEM_PATH, JOURNAL_FILENAME)
+
+"""
+Redfish Event Delivery
+"""
+DELIVERY_POOL_SIZE = 4
+DELIVERY_TIMEOUT_SECONDS = 10
+MAX_IDLE_CONNECTIONS = 2
+SUBSCRIPTION_QUEUE_SIZE = 64
+MAX_RETRY_INTERVAL_SECONDS = 300
+CLOSED_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+"""Errors of a reused connection the client closed while it was idle"""
+
+"""
+Policy when the queue of a subscription is full. DropOldest discards the
+oldest queued event, Suspend stops queueing events for the subscription
+until its queue is delivered
+"""
+OVERFLOW_DROP_OLDEST = 'DropOldest'
+OVERFLOW_SUSPEND = 'Suspend'
 
 """
 Redfish Eventing Enumerations
@@ -63,6 +95,7 @@ class Event(object):
         self.attrs[EVENT_PROPS['ID']] = event_destination_id
         self.attrs[EVENT_PROPS['NAME']] = name
         self.attrs[EVENT_PROPS['CONTEXT']] = context
+        self.envelope = None
 
     def set_event_records(self, event_records):
         """
@@ -70,6 +103,20 @@ class Event(object):
         """
         self.attrs[EVENT_PROPS['EVENTS']] = event_records
 
+    def encode(self, encoded_records):
+        """
+        Returns the JSON of the event with the already encoded event records
+        spliced in as Events. The envelope is encoded once per subscription
+        """
+        if self.envelope is None:
+            attrs = dict((k, v) for k, v in self.attrs.items()
+                         if k != EVENT_PROPS['EVENTS'])
+            self.envelope = json.dumps(attrs)[:-1]
+            if len(attrs):
+                self.envelope = self.envelope + ', '
+        return (self.envelope + '"' + EVENT_PROPS['EVENTS'] + '": ' +
+                encoded_records + '}')
+
 
 class EventerJSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -79,38 +126,292 @@ class EventerJSONEncoder(json.JSONEncoder):
         return o.__dict__
 
 
+def closed_by_peer(error):
+    """Returns True if the error of a request tells the client closed the
+    connection without answering: the connection was reset or closed before
+    the status line. A timeout tells nothing of what the client received"""
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return (isinstance(error, socket.error) and
+            error.errno in CLOSED_CONNECTION_ERRNOS)
+
+
+class ConnectionCache(object):
+    """
+    Persistent HTTP and HTTPS connections to the subscribed clients, keyed by
+    (scheme, host, port). A connection is used by one thread at a time, it is
+    taken from the cache for a request and put back after the response
+    """
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS,
+                 timeout=DELIVERY_TIMEOUT_SECONDS):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(-1)
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def release(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def post(self, url, data):
+        """
+        POSTs data to url and returns the status of the response. A cached
+        connection the client closed before reading the request is replaced
+        by a new connection. A timeout, or a failure once the client may have
+        read the request, is not retried, the event could be posted twice
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        headers = {'Content-Type': 'application/json'}
+        while True:
+            connection = self.acquire(key)
+            reused = connection.sock is not None
+            try:
+                try:
+                    connection.request('POST', path, data, headers)
+                    response = connection.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    if reused is True and closed_by_peer(e):
+                        connection.close()
+                        continue
+                    raise
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(key, connection)
+            return response.status
+
+
+class DeliveryHandle(object):
+    """Tracks the deliveries of one published event"""
+
+    def __init__(self, count):
+        self.pending = count
+        self.delivered = []
+        self.failed = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if count == 0:
+            self.done.set()
+
+    def complete(self, url, success):
+        with self.lock:
+            if success is True:
+                self.delivered.append(url)
+            else:
+                self.failed.append(url)
+            self.pending -= 1
+            if self.pending == 0:
+                self.done.set()
+
+    def wait(self, timeout=None):
+        """Wait for all the deliveries, returns False on timeout"""
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+class DeliveryPool(object):
+    """Fixed number of long lived threads running the deliveries"""
+
+    def __init__(self, size=DELIVERY_POOL_SIZE):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in xrange(size):
+            thr = threading.Thread(target=self.work,
+                                   name="EventDelivery-%d" % i)
+            thr.daemon = True
+            thr.start()
+            self.threads.append(thr)
+
+    def submit(self, function, *args):
+        self.queue.put((function, args))
+
+    def work(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print e
+
+
+class RetryScheduler(object):
+    """
+    Timer heap running delayed retries, one thread sleeps until the earliest
+    retry is due and hands it to the delivery pool
+    """
+
+    def __init__(self, delivery_pool):
+        self.delivery_pool = delivery_pool
+        self.heap = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="EventRetry")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, delay, function, *args):
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap,
+                           (time.time() + delay, self.counter, function, args))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.heap) == 0 or self.heap[0][0] > time.time():
+                    if len(self.heap) == 0:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(self.heap[0][0] - time.time())
+                due, _, function, args = heapq.heappop(self.heap)
+            self.delivery_pool.submit(function, *args)
+
+
+class SubscriptionQueue(object):
+    """
+    Bounded queue of the events waiting for one subscribed client. Only one
+    delivery or scheduled retry of a queue exists at a time, the busy flag
+    is set while it does and the event being delivered is kept in inflight,
+    out of reach of the overflow policy
+    """
+
+    def __init__(self, url, size=SUBSCRIPTION_QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST):
+        self.url = url
+        self.size = size
+        self.overflow = overflow
+        self.events = collections.deque()
+        self.inflight = None
+        self.busy = False
+        self.suspended = False
+        self.attempts = 0
+        self.dropped = 0
+        self.last_latency = None
+        """Seconds taken by the last successful POST"""
+
+    def put(self, data, handle):
+        """Queue the encoded event, returns the (data, handle) entries
+        dropped"""
+        if self.suspended is True:
+            self.dropped += 1
+            return [(data, handle)]
+        dropped = []
+        if len(self.events) >= self.size:
+            if self.overflow == OVERFLOW_SUSPEND:
+                self.suspended = True
+                self.dropped += 1
+                return [(data, handle)]
+            dropped.append(self.events.popleft())
+            self.dropped += 1
+        self.events.append((data, handle))
+        return dropped
+
+    def get_stats(self):
+        return {'QueueDepth': (len(self.events) +
+                               (0 if self.inflight is None else 1)),
+                'LastDeliveryLatencyMs': (None if self.last_latency is None
+                                          else int(self.last_latency * 1000)),
+                'DroppedEvents': self.dropped,
+                'Suspended': self.suspended}
+
+
 class Eventer(object):
     """
     Eventer Handles Emitting Life Cycle and Alert Events to Subscribed Clients
     """
 
     def __init__(self, service_enabled, delivery_retry_attempts,
-                 delivery_retry_interval_seconds):
+                 delivery_retry_interval_seconds,
+                 overflow_policy=OVERFLOW_DROP_OLDEST,
+                 journal_path=SUBSCRIPTIONS_JOURNAL_FP,
+                 subscriptions_path=SUBSCRIPTIONS_FP):
         self.service_enabled = service_enabled
         self.delivery_retry_attempts = delivery_retry_attempts
         self.delivery_retry_interval_seconds = delivery_retry_interval_seconds
+        self.overflow_policy = overflow_policy
+        self.lock = threading.RLock()
+        self.subscriptions_path = subscriptions_path
+        """Subscriptions file of older versions, moved into the journal"""
+        self.journal = SubscriptionJournal(journal_path)
         self.client_URI_endpoints = self.read_subscriptions_from_tmp()
+        self.queues = {}
+        for url in self.client_URI_endpoints.keys():
+            self.queues[url] = SubscriptionQueue(url,
+                                                 overflow=overflow_policy)
+        self.connections = ConnectionCache()
+        self.delivery_pool = DeliveryPool()
+        self.retry_scheduler = RetryScheduler(self.delivery_pool)
+        self.removal_listener = None
+        """Called with the url of a subscription removed after its client
+        failed to respond"""
 
     def create_subscription(self, client_URI_endpoint, event_destination_id,
                             name, subscription_context):
         """
-        Adds the client_URI_endpoint to dict of subscribed clients and writes
-        the subscribed client list to persistent memory
+        Adds the client_URI_endpoint to dict of subscribed clients and appends
+        the subscription to the journal
         """
-        self.client_URI_endpoints[client_URI_endpoint] = \
-            Event(event_destination_id, name, subscription_context)
-        self.write_subscriptions_to_tmp(self.client_URI_endpoints)
+        with self.lock:
+            event = Event(event_destination_id, name, subscription_context)
+            self.client_URI_endpoints[client_URI_endpoint] = event
+            if client_URI_endpoint not in self.queues:
+                self.queues[client_URI_endpoint] = SubscriptionQueue(
+                    client_URI_endpoint, overflow=self.overflow_policy)
+            self.journal.append_add(client_URI_endpoint, event.attrs)
 
     def remove_subscription(self, url):
         """
         Removes the url from the subscribed client dict and ensures that the
         EventDestinationCollection resource with that url is removed as well.
-        Writes these changes to persistent memory
+        Appends the removal to the journal
         """
-        deleted_resource_id = self.client_URI_endpoints.pop(url)
-        # TODO del subscription resource from EventDestinationCollection resrc
-        # TODO implement remove resource method for CollectionResources
-        self.write_subscriptions_to_tmp(self.client_URI_endpoints)
+        with self.lock:
+            deleted_resource_id = self.client_URI_endpoints.pop(url)
+            queue = self.queues.pop(url, None)
+            self.journal.append_remove(url)
+        if queue is not None:
+            if queue.inflight is not None:
+                queue.events.appendleft(queue.inflight)
+                queue.inflight = None
+            while len(queue.events):
+                data, handle = queue.events.popleft()
+                handle.complete(url, False)
+                count(EVENT_DELIVERIES, 'abandoned')
+
+    def get_subscription_stats(self, url):
+        """Returns the queue depth and delivery statistics of a subscription,
+        None if there is no such subscription"""
+        with self.lock:
+            queue = self.queues.get(url)
+            if queue is None:
+                return None
+            return queue.get_stats()
 
     def byteify(self, input):
         """Encodes the openned subscriptions json file into utf-8 strings"""
@@ -126,72 +427,145 @@ class Eventer(object):
 
     def read_subscriptions_from_tmp(self):
         """
-        returns dictionary of the subscriptions json file to persistent memory
+        returns dictionary of the subscriptions replayed from the journal,
+        the subscriptions json file of older versions is moved into the
+        journal the first time
         """
-        if os.path.isfile(SUBSCRIPTIONS_FP) \
-                and os.stat(SUBSCRIPTIONS_FP).st_size > 0:
-            with open(SUBSCRIPTIONS_FP, 'r') as data_file:
+        c_objs = self.byteify(self.journal.replay())
+        migrate = False
+        if len(c_objs) == 0 and os.path.isfile(self.subscriptions_path) \
+                and os.stat(self.subscriptions_path).st_size > 0:
+            with open(self.subscriptions_path, 'r') as data_file:
                 c_objs = self.byteify(json.load(data_file))
-                for c in c_objs:
-                    c_objs[c] = Event(c_objs[c][EVENT_PROPS['ID']],
-                                      c_objs[c][EVENT_PROPS['NAME']],
-                                      c_objs[c][EVENT_PROPS['CONTEXT']])
-                return c_objs
-        return {}
-
-    def write_subscriptions_to_tmp(self, subscriptions):
-        """Writes the subscriptions dictionary to persistent memory"""
-        with open(SUBSCRIPTIONS_FP, 'w') as data_file:
-            json.dump(subscriptions, data_file, cls=EventerJSONEncoder)
+            migrate = True
+        for c in c_objs:
+            c_objs[c] = Event(c_objs[c][EVENT_PROPS['ID']],
+                              c_objs[c][EVENT_PROPS['NAME']],
+                              c_objs[c][EVENT_PROPS['CONTEXT']])
+            if migrate is True:
+                self.journal.append_add(c, c_objs[c].attrs)
+        if migrate is True:
+            os.remove(self.subscriptions_path)
+        return c_objs
 
     def publish_event(self, event_records):
-        """POSTs the dictionary, body, to all subscribed clients"""
+        """
+        Queues the event records for all subscribed clients and returns a
+        DeliveryHandle for the deliveries. A slow or dead client only holds
+        up its own queue
+        """
         if self.service_enabled is False:
-            return
-
-        running_threads = []
-        result_queue = Queue.Queue()
-        for client_URI_endpoint in self.client_URI_endpoints.keys():
-            event = self.client_URI_endpoints[client_URI_endpoint]
-            event.set_event_records(event_records)
-
-            thr = threading.Thread(
-                target=self.post_to_client,
-                args=(
-                    client_URI_endpoint,
-                    event.attrs,
-                    result_queue
-                )
-            )
-            thr.start()
-            running_threads.append(thr)
-
-        for running_thread in running_threads:
-            running_thread.join()
+            return DeliveryHandle(0)
 
-        while not result_queue.empty():
-            failed_client_url = result_queue.get()
-            self.remove_subscription(failed_client_url)
+        encoded_records = json.dumps(event_records, cls=EventerJSONEncoder)
+        with self.lock:
+            handle = DeliveryHandle(len(self.client_URI_endpoints))
+            dropped = []
+            for client_URI_endpoint, event in \
+                    self.client_URI_endpoints.items():
+                data = event.encode(encoded_records)
+                queue = self.queues[client_URI_endpoint]
+                for entry in queue.put(data, handle):
+                    dropped.append((client_URI_endpoint, entry[1]))
+                if queue.busy is False and len(queue.events):
+                    queue.busy = True
+                    self.delivery_pool.submit(self.post_to_client, queue)
+        for url, dropped_handle in dropped:
+            dropped_handle.complete(url, False)
+            count(EVENT_DELIVERIES, 'dropped')
+        return handle
 
-    def post_to_client(self, url, body, result_queue):
+    def post_to_client(self, queue):
         """
-        POSTs the payload, body, to the url of the client and records failures
-        in threadsafe result_queue
+        POSTs the oldest event of the queue to the client. Success moves on
+        to the next event, failure schedules a retry with exponential
+        backoff, and a client failing all retries loses its subscription
         """
-        data = json.dumps(body, cls=EventerJSONEncoder)
-        req = urllib2.Request(url, data)
-        req.add_header('Content-Type', 'application/json')
-        for _ in xrange(self.delivery_retry_attempts):
+        url = queue.url
+        with self.lock:
+            if self.queues.get(url) is not queue:
+                queue.busy = False
+                return
+            if queue.inflight is None:
+                if len(queue.events) == 0:
+                    queue.busy = False
+                    return
+                queue.inflight = queue.events.popleft()
+            data, handle = queue.inflight
+        settled = False
+        """Set once the event is delivered, left for a retry or abandoned with
+        its subscription. An error on the way fails the event in the finally,
+        its handle never stays pending"""
+        try:
+            start = time.time()
             try:
-                connection = urllib2.urlopen(req)
-                if connection.code == 200:
-                    response = connection.read()
-                    connection.close()
-                    return True
-            except urllib2.HTTPError, err:
-                print 'server error occurred'
+                status = self.connections.post(url, data)
+                if not 200 <= status < 300:
+                    print 'server error occurred'
+                    print status
+            except Exception as err:
                 print err
-            time.sleep(self.delivery_retry_interval_seconds)
-        print url, 'client endpoint did not respond'
-        result_queue.put(url)
-        return False
+                status = None
+            if status is not None and 200 <= status < 300:
+                with self.lock:
+                    if self.queues.get(url) is not queue:
+                        queue.busy = False
+                        settled = True
+                        return True
+                    queue.last_latency = time.time() - start
+                    observe(EVENT_DELIVERY_SECONDS, queue.last_latency)
+                    count(EVENT_DELIVERIES, 'delivered')
+                    queue.attempts = 0
+                    queue.inflight = None
+                    settled = True
+                    if len(queue.events):
+                        self.delivery_pool.submit(self.post_to_client, queue)
+                    else:
+                        queue.busy = False
+                        queue.suspended = False
+                handle.complete(url, True)
+                return True
+            queue.attempts += 1
+            if queue.attempts < self.delivery_retry_attempts:
+                count(EVENT_DELIVERIES, 'retried')
+                self.retry_scheduler.schedule(self.retry_delay(queue.attempts),
+                                              self.post_to_client, queue)
+                settled = True
+                return False
+            print url, 'client endpoint did not respond'
+            with self.lock:
+                removed = self.queues.get(url) is queue
+                if removed is True:
+                    self.remove_subscription(url)
+                queue.busy = False
+                settled = True
+            if removed is True and self.removal_listener is not None:
+                self.removal_listener(url)
+            return False
+        finally:
+            if settled is False:
+                self.fail_inflight(queue, handle)
+
+    def fail_inflight(self, queue, handle):
+        """Fail the event being delivered after an unexpected error, so its
+        handle completes, and move the queue on to its next event"""
+        with self.lock:
+            failed = queue.inflight is not None and queue.inflight[1] is handle
+            if failed is True:
+                queue.inflight = None
+                queue.attempts = 0
+            if self.queues.get(queue.url) is queue and len(queue.events):
+                self.delivery_pool.submit(self.post_to_client, queue)
+            else:
+                queue.busy = False
+        if failed is True:
+            handle.complete(queue.url, False)
+            count(EVENT_DELIVERIES, 'abandoned')
+
+    def retry_delay(self, attempts):
+        """Exponential backoff with jitter, between half and all of the
+        doubled interval"""
+        delay = min(MAX_RETRY_INTERVAL_SECONDS,
+                    self.delivery_retry_interval_seconds *
+                    (2 ** (attempts - 1)))
+        return random.uniform(delay / 2.0, delay)
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+
+# Description : Snapshot of the converted inventory kept on local storage,
+#               read at startup instead of enumerating the inventory
+
+import os
+import json
+import time
+import errno
+import shutil
+import tempfile
+from redfish_subscription_journal import fsync_directory
+
+SNAPSHOT_VERSION = 1
+"""Bumped when the format of the snapshot or of the converted inventory
+changes, a snapshot of another version is ignored"""
+
+
+def diff_inventory(old, new):
+    """Returns the objects of new that are not in old or differ from it,
+    key=path, and the paths of old that are not in new"""
+    changed = dict((path, obj) for path, obj in new.items()
+                   if old.get(path) != obj)
+    removed = [path for path in old if path not in new]
+    return changed, removed
+
+
+class InventorySnapshot(object):
+    """
+    Inventory written as one JSON document with its version. The snapshot is
+    written to a temporary file, synced and renamed over the previous one so
+    a crash leaves either the old or the new snapshot
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Returns the inventory of the snapshot, or None if there is none,
+        it can not be read or it is of another version"""
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                print 'reading the inventory snapshot failed', e
+            return None
+        except ValueError as e:
+            print 'ignoring unreadable inventory snapshot', e
+            return None
+        if (not isinstance(snapshot, dict) or
+                snapshot.get('version') != SNAPSHOT_VERSION or
+                not isinstance(snapshot.get('inventory'), dict)):
+            print 'ignoring inventory snapshot of another version'
+            return None
+        return snapshot['inventory']
+
+    def save(self, inventory):
+        """Replace the snapshot with the inventory"""
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + '.',
+                dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'wb') as tmp:
+                json.dump({'version': SNAPSHOT_VERSION,
+                           'saved': time.time(),
+                           'inventory': inventory}, tmp)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.rename(tmp_path, self.path)
+            tmp_path = None
+            fsync_directory(self.path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print 'saving the inventory snapshot failed', e
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+
+if __name__ == '__main__':
+    count = 500
+    directory = tempfile.mkdtemp()
+    try:
+        inventory = {}
+        for i in xrange(count):
+            inventory['/org/openbmc/inventory/system/item%d' % i] = {
+                'fru_type': 'DIMM', 'present': 'True',
+                'Manufacturer': 'Simulated', 'Serial Number': 'SN%d' % i,
+                'Part Number': 'PN-DIMM', 'Name': 'Simulated DIMM'}
+        snapshot = InventorySnapshot(os.path.join(directory,
+                                                  'inventory.json'))
+        start = time.time()
+        snapshot.save(inventory)
+        print "save of %d objects : %.1f ms" % (
+            count, (time.time() - start) * 1000)
+        start = time.time()
+        loaded = snapshot.load()
+        print "load of %d objects : %.1f ms" % (
+            len(loaded), (time.time() - start) * 1000)
+        fresh = dict(loaded)
+        fresh['/org/openbmc/inventory/system/item0'] = dict(
+            inventory['/org/openbmc/inventory/system/item0'], present='False')
+        del fresh['/org/openbmc/inventory/system/item1']
+        start = time.time()
+        changed, removed = diff_inventory(loaded, fresh)
+        print "diff                : %.1f ms, %d changed, %d removed" % (
+            (time.time() - start) * 1000, len(changed), len(removed))
+    finally:
+        shutil.rmtree(directory)
@@ -1,6 +1,88 @@
 # Description : Message Registry for OpenBMC Redfish
 
+import os
+import re
+import copy
 import json
+import threading
+
+GENERAL_ERROR_CODE = "Base.1.0.GeneralError"
+GENERAL_ERROR_MESSAGE = ("A general error has occured. See" +
+                         " Extended info for more information")
+
+
+class CompiledMessage(object):
+    """Message of a registry with the Message template split on its %N
+    arguments, rendered into a new dictionary for every response"""
+
+    def __init__(self, message):
+        self.message = message
+        self.parts = re.split(r'%(\d+)', message.get('Message', ''))
+        """Text and argument numbers alternate, odd items are numbers"""
+
+    def render(self, args):
+        message = copy.deepcopy(self.message)
+        if 'Message' in message:
+            message['Message'] = interpolate_parts(self.parts, args)
+        return message
+
+
+def interpolate_parts(parts, args):
+    pieces = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            pieces.append(part)
+        elif 1 <= int(part) <= len(args):
+            pieces.append(args[int(part) - 1])
+        else:
+            pieces.append('%' + part)
+    return ''.join(pieces)
+
+
+class RegistryService(object):
+    """Process wide store of the message registries on file. Each file is
+    parsed once and parsed again only when its mtime changes. Messages are
+    indexed by 'registry.MessageId'"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mtimes = {}
+        """Dictionary of the mtime of the loaded registries"""
+        self.messages = {}
+        """Dictionary of CompiledMessage, key = registry + '.' + MessageId"""
+
+    def load(self, registry_id):
+        """Parse the registry file if it changed since it was loaded"""
+        try:
+            mtime = os.stat(registry_id).st_mtime
+        except OSError as e:
+            if registry_id not in self.mtimes:
+                print e
+            return
+        if self.mtimes.get(registry_id) == mtime:
+            return
+        with self.lock:
+            if self.mtimes.get(registry_id) == mtime:
+                return
+            with open(registry_id) as registry_file:
+                registry = json.load(registry_file)
+            prefix = registry_id + '.'
+            messages = dict((k, v) for k, v in self.messages.items()
+                            if not k.startswith(prefix))
+            for message_id, message in registry['Messages'].items():
+                messages[prefix + message_id] = CompiledMessage(message)
+            self.messages = messages
+            self.mtimes[registry_id] = mtime
+
+    def get_message(self, registry_id, message_id, args):
+        self.load(registry_id)
+        message = self.messages.get(registry_id + '.' + message_id)
+        if message is None:
+            return {'Message': 'no message match'}
+        return message.render(args)
+
+
+REGISTRY_SERVICE = RegistryService()
 
 
 class MessageRegistry(object):
@@ -9,16 +91,17 @@ class MessageRegistry(object):
 
     def __init__(self, registries_on_file=[]):
         self.registries = registries_on_file
-        self.err_msg = {"error":
-                        {"code": "Base.1.0.GeneralError",
-                         "Message": "A general error has occured. See" +
-                         " Extended info for more information"}}
+        for registry_id in self.registries:
+            REGISTRY_SERVICE.load(registry_id)
 
     def get_error_message(self, registry_id, message_id, *args):
+        err_msg = {"error":
+                   {"code": GENERAL_ERROR_CODE,
+                    "Message": GENERAL_ERROR_MESSAGE}}
         if registry_id in self.registries:
-            self.err_msg["error"]["@Message.ExtendedInfo"] = \
+            err_msg["error"]["@Message.ExtendedInfo"] = \
                 self.get_message(registry_id, message_id, args)
-        return json.dumps(self.err_msg)
+        return json.dumps(err_msg)
 
     def get_message(self, registry_id, message_id, args):
         """
@@ -27,17 +110,7 @@ class MessageRegistry(object):
         will be interpolated into that message and packaged into 'Message' 4
         representation.
         """
-        with open(registry_id) as registry_file:
-            registry = json.load(registry_file)
-            if message_id in registry['Messages']:
-                message = registry['Messages'][message_id]
-                msg_str = message['Message']
-                message['Message'] = self.interpolate_message_args(
-                                            msg_str,
-                                            args)
-                return message
-            else:
-                return {'Message': 'no message match'}
+        return REGISTRY_SERVICE.get_message(registry_id, message_id, args)
 
     def get_extended_messages(self, ext_msg_info_arr=[]):
         extended_info = {'@Message.ExtendedInfo': []}
@@ -51,6 +124,4 @@ class MessageRegistry(object):
         return extended_info
 
     def interpolate_message_args(self, message, args):
-        for i, arg in enumerate(args):
-            message = message.replace('%'+str(i+1), arg)
-        return message
+        return interpolate_parts(re.split(r'%(\d+)', message), args)
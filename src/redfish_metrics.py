@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+
+# Description : Counters and latency histograms of the server, exported in
+#               the Prometheus text format
+
+import time
+import bisect
+import threading
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Upper bounds of the latency histograms in seconds"""
+
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, escape_label(value)) for name, value in
+             list(zip(names, values)) + list(extra)]
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """Counter of one set of label values"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, label_names, label_values):
+        yield name, format_labels(label_names, label_values), self.value
+
+
+class Histogram(object):
+    """Histogram of one set of label values. Every thread counts in a shard
+    of its own so observe takes no lock, the shards are summed up when
+    rendered. The shards of the threads that ended are folded into a base
+    so a server whose worker threads come and go keeps a shard per live
+    thread only"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.local = threading.local()
+        self.shards = []
+        """Thread and its counts per bucket, the last item is the sum"""
+        self.base = [0] * (len(buckets) + 1) + [0.0]
+        """Counts of the threads that ended, see fold_shards"""
+
+    def new_shard(self):
+        shard = [0] * (len(self.buckets) + 1) + [0.0]
+        with self.lock:
+            self.fold_shards()
+            self.shards.append((threading.current_thread(), shard))
+        self.local.shard = shard
+        return shard
+
+    def fold_shards(self):
+        """Add the counts of the threads that ended to the base and drop
+        their shards, a thread that ended observes nothing more. Call with
+        the lock held"""
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for i, value in enumerate(shard):
+                    self.base[i] += value
+        self.shards = live
+
+    def observe(self, value):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.new_shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def samples(self, name, label_names, label_values):
+        with self.lock:
+            self.fold_shards()
+            totals = list(self.base)
+            shards = [shard for thread, shard in self.shards]
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        cumulative = 0
+        bounds = list(self.buckets) + [float('inf')]
+        for bound, count in zip(bounds, totals):
+            cumulative += count
+            yield (name + '_bucket',
+                   format_labels(label_names, label_values,
+                                 [('le', format_value(bound))]),
+                   cumulative)
+        labels = format_labels(label_names, label_values)
+        yield name + '_sum', labels, totals[-1]
+        yield name + '_count', labels, cumulative
+
+
+class MetricFamily(object):
+    """Metric with its children, one per set of label values"""
+
+    def __init__(self, name, help_text, metric_type, label_names, factory):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.children = {}
+        """key = tuple of the label values"""
+
+    def labels(self, *values):
+        """Returns the child of the label values, created on first use"""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.factory()
+                    self.children[values] = child
+        return child
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        for values in sorted(self.children.keys()):
+            child = self.children[values]
+            for name, labels, value in child.samples(
+                    self.name, self.label_names, values):
+                lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return lines
+
+
+class MetricsRegistry(object):
+    """All the metrics of the process. Recording can be switched off to
+    measure its cost"""
+
+    def __init__(self):
+        self.families = []
+        self.enabled = True
+
+    def counter(self, name, help_text, label_names=()):
+        family = MetricFamily(name, help_text, 'counter', label_names,
+                              Counter)
+        self.families.append(family)
+        return family
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=LATENCY_BUCKETS):
+        family = MetricFamily(name, help_text, 'histogram', label_names,
+                              lambda: Histogram(buckets))
+        self.families.append(family)
+        return family
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format"""
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+REQUEST_SECONDS = METRICS.histogram(
+    'redfish_request_duration_seconds',
+    'Time taken to answer a request, by method and resource class',
+    ('method', 'route'))
+
+FILL_DYNAMIC_SECONDS = METRICS.histogram(
+    'redfish_fill_dynamic_data_seconds',
+    'Time taken by fill_dynamic_data, by resource class', ('resource',))
+
+DBUS_CALL_SECONDS = METRICS.histogram(
+    'redfish_dbus_call_duration_seconds',
+    'Time taken by D-Bus calls of the providers, by method', ('method',))
+
+DBUS_CALL_ERRORS = METRICS.counter(
+    'redfish_dbus_call_errors_total',
+    'D-Bus calls of the providers that failed, by method', ('method',))
+
+EVENT_DELIVERIES = METRICS.counter(
+    'redfish_event_deliveries_total',
+    'Events for subscribers by outcome: delivered, retried, abandoned '
+    'after the last retry or dropped on queue overflow', ('outcome',))
+
+EVENT_DELIVERY_SECONDS = METRICS.histogram(
+    'redfish_event_delivery_duration_seconds',
+    'Time taken by successful POSTs of events to subscribers')
+
+
+def observe(family, seconds, *labels):
+    """Records the seconds in the histogram child of the labels"""
+    if METRICS.enabled is True:
+        family.labels(*labels).observe(seconds)
+
+
+def count(family, *labels):
+    if METRICS.enabled is True:
+        family.labels(*labels).inc()
+
+
+def observe_dbus_call(method, start, failed=False):
+    """Records a D-Bus call that began at start"""
+    if METRICS.enabled is True:
+        DBUS_CALL_SECONDS.labels(method).observe(time.time() - start)
+        if failed is True:
+            DBUS_CALL_ERRORS.labels(method).inc()
+
+
+if __name__ == '__main__':
+    runs = 200000
+    start = time.time()
+    for _ in xrange(runs):
+        time.time()
+    clock = (time.time() - start) / runs
+    start = time.time()
+    for _ in xrange(runs):
+        observe(REQUEST_SECONDS, time.time() - start, 'GET', 'System')
+    recorded = (time.time() - start) / runs
+    print "one request recorded : %.2f us, clock read %.2f us" % (
+        recorded * 1e6, clock * 1e6)
+    histogram = REQUEST_SECONDS.labels('GET', 'System')
+    for _ in xrange(50):
+        worker = threading.Thread(target=histogram.observe, args=(0.001,))
+        worker.start()
+        worker.join()
+    counted = [line for line in METRICS.render().splitlines() if
+               line.startswith('redfish_request_duration_seconds_count')]
+    print "shards after 50 threads ended : %d, %s of %d" % (
+        len(histogram.shards), counted[0], runs + 50)
+    print METRICS.render()[:400]
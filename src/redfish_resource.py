@@ -5,13 +5,20 @@
  Redfish Resource Types
 """
 
+import re
 import json
+import urllib
+import time
+import zlib
+import hashlib
+import threading
 from obmc_redfish_providers import *
 from redfish_eventer import *
 from redfish_message_registry import *
-import os
-import crypt
-import spwd
+from redfish_session_store import SessionStore, SESSION_TIMEOUT_SECONDS
+from redfish_credential_cache import CredentialCache
+from redfish_startup import StartupPipeline
+from redfish_metrics import METRICS, REQUEST_SECONDS, FILL_DYNAMIC_SECONDS
 
 REDFISH_VERSION = str("1.0.3")
 REDFISH_COPY_RIGHT = ("Copyright 2014-2016 Distributed Management "
@@ -24,10 +31,363 @@ ODATA_ID = "@odata.id"
 ODATA_TYPE = "@odata.type"
 ODATA_CONTEXT = "@odata.context"
 
+JSON_CONTENT_TYPE = "application/json"
+XML_CONTENT_TYPE = "application/xml"
+EDMX_NAMESPACE = "http://docs.oasis-open.org/odata/ns/edmx"
+EDM_NAMESPACE = "http://docs.oasis-open.org/odata/ns/edm"
+
+"""
+$expand query, the type of links expanded and the number of levels
+"""
+EXPAND_ALL = "*"
+EXPAND_SUBORDINATE = "."
+EXPAND_LINKS = "~"
+EXPAND_PATTERN = re.compile(r'^([*.~])(?:\(\$levels=(\d+)\))?$')
+MAX_EXPAND_LEVELS = 6
+ODATA_ANNOTATION = "@odata."
+QUERY_PARAMETERS = ('$expand', '$select', '$top', '$skip')
+
+"""
+Content codings of the responses, with the window bits that make zlib
+write the gzip or the zlib container
+"""
+CONTENT_CODINGS = {'gzip': 16 + zlib.MAX_WBITS,
+                   'deflate': zlib.MAX_WBITS}
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1024
+"""Bodies smaller than this are sent as they are"""
+
+BUILD_RETRY_SECONDS = 1.0
+"""Wait after the first failed build of a lazy subtree before the next
+one, doubled after every further failure up to BUILD_RETRY_MAX_SECONDS"""
+BUILD_RETRY_MAX_SECONDS = 60.0
+
 
 ERROR_REGISTRY_FILE_LOCATION = 'error_message_registry.json'
 REGISTRY_FILES = [ERROR_REGISTRY_FILE_LOCATION]
 
+MESSAGE_REGISTRY = MessageRegistry(REGISTRY_FILES)
+"""Message registry shared by all the resources"""
+
+
+def path_segments(path):
+    """Drop the empty segments left in a split path by leading, trailing or
+    repeated slashes"""
+    return [p for p in path if p]
+
+
+def path_key(path):
+    """Returns the key of a split path in the path index, the same form as the
+    path attribute of the resource"""
+    return "/" + "/".join(path_segments(path))
+
+
+class PathIndex(dict):
+    """Index of the resources of a tree keyed by path. The generation counts
+    the changes to the shape of the tree, the documents that describe the
+    whole tree are cached per generation"""
+
+    def __init__(self, *args, **kw):
+        super(PathIndex, self).__init__(*args, **kw)
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super(PathIndex, self).__setitem__(key, value)
+            self.generation += 1
+
+    def pop(self, *args):
+        with self.lock:
+            self.generation += 1
+            return super(PathIndex, self).pop(*args)
+
+
+class LazySubtree(object):
+    """Children of the nodes at paths, added by build on the first request
+    under one of the paths or by the warm-up. A build that fails is tried
+    again by a request after a backoff, the requests until then get no
+    subtree instead of waiting for a build that is likely to fail too"""
+
+    def __init__(self, paths, build):
+        self.paths = paths
+        self.build = build
+        self.lock = threading.Lock()
+        self.built = False
+        self.retry_delay = 0
+        """Backoff after the last failed build, 0 until a build fails"""
+        self.retry_at = 0
+        """Time before which no build is tried"""
+
+    def covers(self, key, descendants=False):
+        """Returns True if the resource at key is one of the paths or under
+        one, or with descendants also if one of the paths is under key"""
+        for path in self.paths:
+            if (key == path or key.startswith(path + "/") or
+                    key.startswith(path + "#")):
+                return True
+            if descendants is True and path.startswith(key.rstrip("/") + "/"):
+                return True
+        return False
+
+    def populate(self):
+        """Build the subtree unless it is, returns True if it is built. The
+        backoff is checked before the lock as well, so a request does not
+        queue behind a build that is going to fail"""
+        if self.built is False and time.time() < self.retry_at:
+            return False
+        with self.lock:
+            if self.built is False and time.time() >= self.retry_at:
+                try:
+                    self.build()
+                    self.built = True
+                    self.retry_delay = 0
+                except Exception as e:
+                    self.retry_delay = min(
+                        BUILD_RETRY_MAX_SECONDS,
+                        max(BUILD_RETRY_SECONDS, self.retry_delay * 2))
+                    self.retry_at = time.time() + self.retry_delay
+                    print "building %s failed: %s, next try in %.0f s" % (
+                        ", ".join(self.paths), e, self.retry_delay)
+            return self.built
+
+
+class RedfishAttrs(dict):
+    """Dictionary of redfish attributes that counts its changes, the count
+    tells when the encoded copy of the attributes is out of date. Only the
+    top level keys are tracked, call touch after changing a nested value in
+    place"""
+
+    def __init__(self, *args, **kw):
+        super(RedfishAttrs, self).__init__(*args, **kw)
+        self.version = 0
+
+    def touch(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        if key not in self or dict.__getitem__(self, key) != value:
+            self.version += 1
+        super(RedfishAttrs, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(RedfishAttrs, self).__delitem__(key)
+        self.version += 1
+
+    def clear(self):
+        super(RedfishAttrs, self).clear()
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super(RedfishAttrs, self).pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super(RedfishAttrs, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+
+class RedfishEntity(object):
+    """Encoded body of a response along with its strong entity tag"""
+
+    def __init__(self, body, error=False, content_type=JSON_CONTENT_TYPE,
+                 status=None):
+        self.body = body
+        """Encoded document, json unless content_type says otherwise"""
+
+        self.content_type = content_type
+
+        self.status = status
+        """HTTP status of the response, 200 or 404 for errors by default"""
+
+        if status is None:
+            self.status = 404 if error is True else 200
+
+        self.encoded = {}
+        """Compressed copies of the body, key = content coding. Cached
+        entities compress once per change of the body"""
+
+        self.error = error
+        """Flag to show if the body is an error response"""
+
+        self.etag = None
+        """Entity tag of the body, None for error responses"""
+
+        if error is False:
+            self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+    def match(self, if_none_match, coding=None):
+        """Returns True if the If-None-Match header value matches the tag of
+        the body sent with the content coding"""
+        etag = self.get_etag(coding)
+        if etag is None or if_none_match is None:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag == etag:
+                return True
+        return False
+
+    def get_etag(self, coding=None):
+        """Returns the entity tag of the body sent with the content coding,
+        every coding of the body has its own strong tag"""
+        if self.etag is None or coding is None:
+            return self.etag
+        return self.etag[:-1] + '-' + coding + '"'
+
+    def select_coding(self, accepted):
+        """Returns the first content coding of the accepted list that the
+        body is worth compressing with, or None to send it as it is"""
+        if len(self.body) < COMPRESSION_MIN_SIZE:
+            return None
+        for coding in accepted:
+            if coding in CONTENT_CODINGS:
+                return coding
+        return None
+
+    def get_body(self, coding=None):
+        """Returns the body compressed with the content coding"""
+        if coding is None:
+            return self.body
+        body = self.encoded.get(coding)
+        if body is None:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                          CONTENT_CODINGS[coding])
+            body = compressor.compress(self.body) + compressor.flush()
+            self.encoded[coding] = body
+        return body
+
+
+def parse_expand(value):
+    """Returns the expand type and levels of a $expand query value, or None
+    if the value is not understood"""
+    match = EXPAND_PATTERN.match(value)
+    if match is None:
+        return None
+    levels = int(match.group(2) or 1)
+    if levels < 1:
+        return None
+    return match.group(1), min(levels, MAX_EXPAND_LEVELS)
+
+
+class ExpandRequest(object):
+    """Builds the document of a resource with its navigation links replaced by
+    the resources they point at. Every resource reached is filled once for
+    the request, however many links point at it"""
+
+    def __init__(self, path_index, expand_type, levels):
+        self.path_index = path_index
+        self.expand_type = expand_type
+        self.levels = levels
+        self.attrs = {}
+        """Filled attrs of the resources reached, key = path"""
+
+    def get_attrs(self, node):
+        if node.path not in self.attrs:
+            self.attrs[node.path] = node.export_attrs()
+        return self.attrs[node.path]
+
+    def expand(self, document):
+        """Returns the expanded copy of the document of a resource"""
+        return self.expand_value(document, self.levels, False)
+
+    def expand_value(self, value, levels, in_links):
+        """Returns a copy of value with the links expanded, the attrs handed
+        out by the resources are never changed"""
+        if isinstance(value, dict):
+            if levels > 0 and value.keys() == [ODATA_ID]:
+                node = self.path_index.get(value[ODATA_ID])
+                if node is not None and self.expands(in_links):
+                    return self.expand_value(self.get_attrs(node),
+                                             levels - 1, False)
+            return dict((key, self.expand_value(item, levels,
+                                                in_links or key == "Links"))
+                        for key, item in value.items())
+        elif isinstance(value, list):
+            return [self.expand_value(item, levels, in_links)
+                    for item in value]
+        return value
+
+    def expands(self, in_links):
+        if self.expand_type == EXPAND_ALL:
+            return True
+        elif self.expand_type == EXPAND_LINKS:
+            return in_links
+        return not in_links
+
+
+def parse_select(value):
+    """Returns the property paths of a $select query value split on '/', or
+    None if a property is empty"""
+    select = [p.strip().split('/') for p in value.split(',')]
+    for path in select:
+        if "" in path:
+            return None
+    return select
+
+
+def parse_count(value):
+    """Returns the number of a $top or $skip query value, or None if it is
+    not a non-negative integer"""
+    if value is None or value.isdigit() is False:
+        return None
+    return int(value)
+
+
+def select_attrs(data, select):
+    """Returns the properties of data named by the $select paths along with
+    their annotations, the @odata annotations of the resource are kept"""
+    selected = dict((key, value) for key, value in data.items()
+                    if key.startswith(ODATA_ANNOTATION))
+    for path in select:
+        source = data
+        target = selected
+        for name in path[:-1]:
+            if not isinstance(source.get(name), dict):
+                source = None
+                break
+            source = source[name]
+            target = target.setdefault(name, {})
+        if source is None:
+            continue
+        for key, value in source.items():
+            if key == path[-1] or key.startswith(path[-1] + "@"):
+                target[key] = value
+    return selected
+
+
+def page_members(data, path, top, skip, query={}):
+    """Returns a copy of data with Members cut to the page asked for by $top
+    and $skip, along with the link to the next page. The link keeps the
+    other query options so every page has the same shape, a $top of 0 has
+    no next page"""
+    members = data["Members"]
+    start = skip or 0
+    end = len(members) if top is None else start + top
+    data = dict(data)
+    data["Members"] = members[start:end]
+    if top != 0 and end < len(members):
+        options = []
+        for parameter in QUERY_PARAMETERS:
+            value = query.get(parameter)
+            if value is not None and parameter not in ('$top', '$skip'):
+                options.append("%s=%s" % (
+                    parameter, urllib.quote(value, safe="$*.~(),/=;")))
+        options.append("$skip=%d&$top=%d" % (end, top))
+        data["Members@odata.nextLink"] = "%s?%s" % (path, "&".join(options))
+    return data
+
 
 def print_dict(name, data):
     if (isinstance(data, dict)):
@@ -44,12 +404,44 @@ class RedfishBase(object):
 
     def __init__(self, name):
 
-        self.attrs = {}
+        self.attrs = RedfishAttrs()
         """Dictionary of redfish attributes"""
 
+        self.entity = None
+        """Encoded attrs, reused by get requests until attrs change"""
+
+        self.entity_version = None
+        """Version of attrs the entity was encoded from"""
+
+        self.lock = threading.RLock()
+        """Held while attrs or the children of the node change, or while the
+        attrs are filled and encoded. Take the lock of a parent before the
+        lock of a child, never the other way"""
+
         self.child = []
         """List of children resources"""
 
+        self.child_index = {}
+        """Dictionary of children resources, key=name, kept in sync with
+        child for constant time lookups"""
+
+        self.path_index = None
+        """Dictionary of every resource in the tree keyed by full path, shared
+        by all the nodes of the tree, set when the node is added to it"""
+
+        self.dynamic_properties = None
+        """Set of the top level attrs filled by fill_dynamic_data, None if
+        not known. A $select of none of them skips fill_dynamic_data"""
+
+        self.fill_metric = None
+        """Histogram of the time taken by fill_dynamic_data, kept only for
+        the classes that extend it"""
+
+        if (self.__class__.fill_dynamic_data.im_func is not
+                RedfishBase.fill_dynamic_data.im_func):
+            self.fill_metric = FILL_DYNAMIC_SECONDS.labels(
+                self.__class__.__name__)
+
         self.actions = {}
         """Dictonary for action, key=Function, value = List of allowable
         values"""
@@ -76,7 +468,7 @@ class RedfishBase(object):
         """Flag to show if the node if a leaf, useful for objects that are
         embedded into a node"""
 
-        self.message_registry = MessageRegistry(REGISTRY_FILES)
+        self.message_registry = MESSAGE_REGISTRY
 
     def get_redfish_web_link(self):
         """Returns the link of online schema at redfish website, use it to
@@ -91,6 +483,17 @@ class RedfishBase(object):
                     "." + path_list[0] + "json")
         return web_link
 
+    def get_schema_namespaces(self):
+        """Returns the unversioned and the versioned namespace of the schema
+        of the resource, use it to create the CSDL metadata document"""
+        if self.namespace == "":
+            return []
+        namespaces = [self.namespace]
+        path_list = self.version.split(".")
+        if len(path_list) > 1:
+            namespaces.append(self.namespace + "." + path_list[0])
+        return namespaces
+
     def get_document(self):
         doc = {}
         doc["name"] = self.name
@@ -107,15 +510,62 @@ class RedfishBase(object):
 
     def add_child(self, obj):
         """Add a child to the node"""
-        self.child.append(obj)
-        obj.parent = self
-        obj.provider = self.provider
-        if obj.is_leaf is False:
-            obj.path = str(self.path + "/" + obj.name)
-            obj.update_metadata_path()
-        else:
-            obj.path = str(self.path + "#/" + obj.name)
-        obj.attrs[ODATA_ID] = obj.path
+        with self.lock:
+            self.child.append(obj)
+            self.child_index[obj.name] = obj
+            obj.parent = self
+            obj.provider = self.provider
+            obj.path_index = self.path_index
+            if obj.is_leaf is False:
+                obj.path = str(self.path + "/" + obj.name)
+                obj.update_metadata_path()
+            else:
+                obj.path = str(self.path + "#/" + obj.name)
+            obj.attrs[ODATA_ID] = obj.path
+            if self.path_index is not None:
+                self.path_index[obj.path] = obj
+
+    def remove_child(self, obj):
+        """Remove a child and all of its subtree from the node, returns False
+        if obj is not a child, it may have been removed by another request"""
+        with self.lock:
+            if self.child_index.get(obj.name) is not obj:
+                return False
+            self.child.remove(obj)
+            del self.child_index[obj.name]
+        q = [obj]
+        while len(q):
+            node = q.pop(-1)
+            with node.lock:
+                if node.path_index is not None:
+                    node.path_index.pop(node.path, None)
+                    node.path_index = None
+                q.extend(node.child)
+        return True
+
+    def get_children(self):
+        """Returns a copy of the list of children"""
+        with self.lock:
+            return list(self.child)
+
+    def get_child(self, name):
+        """Returns the child with the name, or None"""
+        return self.child_index.get(name)
+
+    def find_node(self, path):
+        """Walk the split path down from this node, the first segment names
+        this node. Returns the node found and None, or None and the segment
+        that does not exist. Leaf segments may carry the '#' of the path"""
+        path = path_segments(path)
+        if len(path) == 0 or path[0] != self.name:
+            return None, path[0] if len(path) else ""
+        node = self
+        for name in path[1:]:
+            child = node.get_child(name.rstrip("#"))
+            if child is None:
+                return None, name
+            node = child
+        return node, None
 
     def print_attr(self):
         """debug function for printing values"""
@@ -152,41 +602,32 @@ class RedfishBase(object):
         pass
 
     def del_data(self, path, op):
-        if path[0] != self.name or len(path) == 1:
-            print "Error:" + self.name + str(len(path)) + str(path[0])
+        """Delete the resource at path, the parent of the resource handles the
+        request"""
+        path = path_segments(path)
+        if len(path) < 2:
             return self.message_registry.get_error_message(
                     ERROR_REGISTRY_FILE_LOCATION,
-                    "ResourceDoesNotExist", path[0])
-        elif len(path) > 2:
-            for children in self.child:
-                if children.name == path[1]:
-                    path.pop(0)
-                    return children.del_data(path, op)
-            else:
-                return self.message_registry.get_error_message(
-                        ERROR_REGISTRY_FILE_LOCATION,
-                        "ResourceDoesNotExist", path[1])
-        else:
-            return self.del_req(op)
+                    "ResourceDoesNotExist", path[0] if len(path) else "")
+        node, missing = self.find_node(path[:-1])
+        if node is None:
+            return self.message_registry.get_error_message(
+                    ERROR_REGISTRY_FILE_LOCATION,
+                    "ResourceDoesNotExist", missing)
+        if node.get_child(path[-1]) is None:
+            return self.message_registry.get_error_message(
+                    ERROR_REGISTRY_FILE_LOCATION,
+                    "ResourceDoesNotExist", path[-1])
+        return node.del_req(path[-1])
 
     def post_data(self, path, op):
-        """Empty post function"""
-        if path[0] != self.name or len(path) == 0:
-            print "Error:" + self.name + str(len(path)) + str(path[0])
+        """Post the request to the resource at path"""
+        node, missing = self.find_node(path)
+        if node is None:
             return self.message_registry.get_error_message(
                     ERROR_REGISTRY_FILE_LOCATION,
-                    "ResourceDoesNotExist", path[0])
-        elif len(path) > 1:
-            for children in self.child:
-                if children.name == path[1]:
-                    path.pop(0)
-                    return children.post_data(path, op)
-            else:
-                return self.message_registry.get_error_message(
-                        ERROR_REGISTRY_FILE_LOCATION,
-                        "ResourceDoesNotExist", path[1])
-        else:
-            return self.post_req(op)
+                    "ResourceDoesNotExist", missing)
+        return node.post_req(op)
 
     def add_related_object(self, name, obj):
         """Add a related object to this item"""
@@ -195,100 +636,126 @@ class RedfishBase(object):
         if name not in self.attrs["Links"]:
             self.attrs["Links"][name] = []
         self.attrs["Links"][name].append(dict([(ODATA_ID, obj.path)]))
+        self.attrs.touch()
+
+    def remove_related_object(self, name, obj):
+        """Remove a related object added by add_related_object"""
+        with self.lock:
+            links = self.attrs.get("Links", {})
+            if name in links:
+                links[name] = [link for link in links[name]
+                               if link[ODATA_ID] != obj.path]
+                self.attrs.touch()
 
     def get_export_data(self, op):
-        """Export the json data to server"""
-        """FIXME: this with correct functions calls in case of error"""
-        if op[0] != self.name or len(op) == 0:
-            print "Error:" + self.name + str(len(op)) + str(op[0])
+        """Export the json data of the resource at path op to server"""
+        node, missing = self.find_node(op)
+        if node is None:
             return self.message_registry.get_error_message(
                     ERROR_REGISTRY_FILE_LOCATION,
-                    "ResourceDoesNotExist", op[0])
-        elif len(op) > 1:
-            for children in self.child:
-                if children.name == op[1]:
-                    op.pop(0)
-                    return children.get_export_data(op)
+                    "ResourceDoesNotExist", missing)
+        return node.export_data()
+
+    def export_data(self):
+        """Export the json data of this resource"""
+        return self.export_entity().body
+
+    def export_entity(self):
+        """Export the json data of this resource as an entity, encoding attrs
+        only if they changed since the last request"""
+        with self.lock:
+            self.fill_data()
+            if (self.entity is None or
+                    self.entity_version != self.attrs.version):
+                self.entity = RedfishEntity(json.dumps(self.attrs))
+                self.entity_version = self.attrs.version
+            return self.entity
+
+    def export_attrs(self, properties=None):
+        """Returns a copy of the filled attrs, properties is the set of top
+        level attrs the request asks for, None for all of them"""
+        with self.lock:
+            self.fill_data(properties)
+            return dict(self.attrs)
+
+    def fill_data(self, properties=None):
+        """Fill the static data on first use and the dynamic data, unless
+        none of the properties asked for is dynamic. Call with the lock
+        held"""
+        if self.static_data_filled == 0:
+            self.fill_static_data()
+            self.static_data_filled = 1
+        if (properties is None or self.dynamic_properties is None or
+                not self.dynamic_properties.isdisjoint(properties)):
+            if self.fill_metric is None or METRICS.enabled is False:
+                self.fill_dynamic_data()
             else:
-                return self.message_registry.get_error_message(
-                        ERROR_REGISTRY_FILE_LOCATION,
-                        "ResourceDoesNotExist", op[1])
-        else:
-            if self.static_data_filled == 0:
-                self.fill_static_data()
-                self.static_data_filled = 1
-            self.fill_dynamic_data()
-            print "Returning" + str(op)
-            return json.dumps(self.attrs)
+                start = time.time()
+                self.fill_dynamic_data()
+                self.fill_metric.observe(time.time() - start)
 
     def action(self, path, op):
         """Perfrom the requested action and return the information"""
         """FIXME: Fill in the details for Error Class"""
-        if path[0] != self.name or len(path) == 1:
+        path = path_segments(path)
+        if len(path) < 3:
+            return self.message_registry.get_error_message(
+                    ERROR_REGISTRY_FILE_LOCATION, "ResourceDoesNotExist",
+                    path[-1] if len(path) else "")
+        node, missing = self.find_node(path[:-2])
+        if node is None:
+            return self.message_registry.get_error_message(
+                    ERROR_REGISTRY_FILE_LOCATION, "ResourceDoesNotExist",
+                    missing)
+        return node.do_action(path[-2:], op)
+
+    def do_action(self, path, op):
+        """Perform the action of this resource, path is the 'Actions' segment
+        followed by the action name"""
+        if path[0] != 'Actions':
             return self.message_registry.get_error_message(
                     ERROR_REGISTRY_FILE_LOCATION, "ResourceDoesNotExist",
                     path[0])
-        elif len(path) > 3:
-            for children in self.child:
-                if children.name == path[1]:
-                    path.pop(0)
-                    return children.action(path, op)
-            else:
-                return self.message_registry.get_error_message(
-                        ERROR_REGISTRY_FILE_LOCATION, "ResourceDoesNotExist",
-                        path[1])
         else:
-            if path[1] != 'Actions':
-                return self.message_registry.get_error_message(
-                        ERROR_REGISTRY_FILE_LOCATION, "ResourceDoesNotExist",
-                        path[1])
-            else:
-                action_list = path[2].split('.')
-                uri_namespace = action_list[0]
-                action = action_list[1]
-                action_type = action + "Type"
-                if self.static_data_filled == 0:
-                    self.fill_static_data()
-                    self.static_data_filled = 1
-                self.fill_dynamic_data()
-                print action
-                print action_type
-                if action in self.actions.keys():
+            action_list = path[1].split('.')
+            uri_namespace = action_list[0]
+            action = action_list[1]
+            action_type = action + "Type"
+            with self.lock:
+                self.fill_data()
+            if action in self.actions.keys():
+                try:
+                    method = getattr(self, str(action.lower()))
                     try:
-                        method = getattr(self, str(action.lower()))
-                        try:
-                            method_arg = op.json[action_type]
-                            print method_arg
-                        except ValueError:
-                            return self.message_registry.get_error_message(
-                                    ERROR_REGISTRY_FILE_LOCATION,
-                                    "PropertyValueNotInList",
-                                    action, "Method does not exist")
-                        if method_arg is None:
-                            return self.message_registry.get_error_message(
-                                    ERROR_REGISTRY_FILE_LOCATION,
-                                    "PropertyValueNotInList",
-                                    action, "None")
-                        if method_arg in self.actions[action]:
-                            print "Argument is " + str(method_arg)
-                            method(method_arg)
-                        else:
-                            return self.message_registry.get_error_message(
-                                    ERROR_REGISTRY_FILE_LOCATION,
-                                    "PropertyValueNotInList",
-                                    action, method_arg)
-                    except AttributeError:
+                        method_arg = op.json[action_type]
+                    except ValueError:
                         return self.message_registry.get_error_message(
                                 ERROR_REGISTRY_FILE_LOCATION,
-                                "ResourceDoesNotExist",
-                                action)
-                else:
+                                "PropertyValueNotInList",
+                                action, "Method does not exist")
+                    if method_arg is None:
+                        return self.message_registry.get_error_message(
+                                ERROR_REGISTRY_FILE_LOCATION,
+                                "PropertyValueNotInList",
+                                action, "None")
+                    if method_arg in self.actions[action]:
+                        method(method_arg)
+                    else:
+                        return self.message_registry.get_error_message(
+                                ERROR_REGISTRY_FILE_LOCATION,
+                                "PropertyValueNotInList",
+                                action, method_arg)
+                except AttributeError:
                     return self.message_registry.get_error_message(
                             ERROR_REGISTRY_FILE_LOCATION,
                             "ResourceDoesNotExist",
                             action)
-                print uri_namespace + action + str(op.POST.items())
-                return
+            else:
+                return self.message_registry.get_error_message(
+                        ERROR_REGISTRY_FILE_LOCATION,
+                        "ResourceDoesNotExist",
+                        action)
+            return
 
     def add_action(self, act, op):
         if(isinstance(op, list)):
@@ -301,6 +768,7 @@ class RedfishBase(object):
                 self.attrs['Actions'] = {}
             self.attrs['Actions'][key] = dict([('target', target),
                                                (allowed_values, op)])
+            self.attrs.touch()
         else:
             print "Error: Pass a list"
 
@@ -321,14 +789,30 @@ class RedfishCollectionBase(RedfishBase):
         self.attrs["Members@odata.count"] = 0
 
     def add_child(self, obj):
-        super(RedfishCollectionBase, self).add_child(obj)
-        self.attrs["Members@odata.count"] += 1
+        """Members is replaced rather than appended to, lists handed out
+        with the attrs are never changed"""
+        with self.lock:
+            super(RedfishCollectionBase, self).add_child(obj)
+            self.attrs["Members@odata.count"] += 1
+            if "Members" in self.attrs:
+                self.attrs["Members"] = (self.attrs["Members"] +
+                                         [dict([(ODATA_ID, obj.path)])])
+
+    def remove_child(self, obj):
+        with self.lock:
+            path = obj.path
+            if not super(RedfishCollectionBase, self).remove_child(obj):
+                return False
+            self.attrs["Members@odata.count"] -= 1
+            if "Members" in self.attrs:
+                self.attrs["Members"] = [m for m in self.attrs["Members"]
+                                         if m[ODATA_ID] != path]
+            return True
 
     def fill_static_data(self):
         super(RedfishCollectionBase, self).fill_static_data()
-        self.attrs["Members"] = []
-        for children in self.child:
-            self.attrs["Members"].append(dict([(ODATA_ID, children.path)]))
+        self.attrs["Members"] = [dict([(ODATA_ID, children.path)])
+                                 for children in self.child]
 
     def update_metadata_path(self):
         self.self_metadata_path = (self.parent.child_metadata_path +
@@ -343,15 +827,17 @@ class RedfishRoot(RedfishBase):
         super(RedfishRoot, self).__init__(name)
         self.path = str("/" + name)
         self.provider = provider
+        self.path_index = PathIndex({self.path: self})
         self.child_metadata_path = self.path
         self.self_metadata_path = self.path
 
     def add_child(self, ob):
         """When adding child for root, delete all the attributes"""
-        super(RedfishRoot, self).add_child(ob)
-        for key in self.attrs.keys():
-            del self.attrs[key]
-        self.attrs[ob.name] = ob.path
+        with self.lock:
+            super(RedfishRoot, self).add_child(ob)
+            for key in self.attrs.keys():
+                del self.attrs[key]
+            self.attrs[ob.name] = ob.path
 
     def fill_static_data(self):
         pass
@@ -425,9 +911,23 @@ class Chassis(RedfishBase):
         super(Chassis, self).__init__(name)
         self.namespace = "Chassis"
         self.version = "v1_0_3.Chassis"
-        for keys in argv.keys():
-            if keys is not "UUID":
-                self.attrs[keys] = argv[keys].strip()
+        self.dynamic_properties = set(["IndicatorLed", "PowerState"])
+        self.inventory_keys = set()
+        """Attrs set by the last set_inventory"""
+        self.set_inventory(argv)
+
+    def set_inventory(self, argv):
+        """Set the attrs read from the inventory, the ones the inventory no
+        longer has are removed"""
+        with self.lock:
+            inventory_keys = set()
+            for keys in argv.keys():
+                if keys is not "UUID":
+                    self.attrs[keys] = argv[keys].strip()
+                    inventory_keys.add(keys)
+            for keys in self.inventory_keys - inventory_keys:
+                self.attrs.pop(keys, None)
+            self.inventory_keys = inventory_keys
 
     def fill_static_data(self):
         super(Chassis, self).fill_static_data()
@@ -437,17 +937,19 @@ class Chassis(RedfishBase):
                                       'BlinkFast',
                                       'BlinkSlow'])
         for children in self.child:
-            self.attrs[children.name] = dict([(ODATA_TYPE, children.path)])
+            self.attrs[children.name] = dict([(ODATA_ID, children.path)])
 
     def ledupdate(self, op):
         self.provider.led_operation(op, 'identify')
 
     def fill_dynamic_data(self):
         super(Chassis, self).fill_dynamic_data()
-        led_state = self.provider.led_operation('State', 'identify')
+        led_state, power_state = wait_all([
+            self.provider.led_operation_async('State', 'identify'),
+            self.provider.get_system_state_async()])
         if led_state is not None:
             self.attrs['IndicatorLed'] = led_state
-        self.attrs['PowerState'] = self.provider.get_system_state()
+        self.attrs['PowerState'] = power_state
 
 
 class System(RedfishBase):
@@ -457,13 +959,28 @@ class System(RedfishBase):
         super(System, self).__init__(name)
         self.namespace = "ComputerSystem"
         self.version = "v1_0_3.ComputerSystem"
-        for keys in argv.keys():
-            if keys is "UUID":
-                uuid = argv[keys].split(':')
-                if len(uuid) > 1:
-                    self.attrs[keys] = self.fancy_uuid(uuid[1])
-            else:
-                self.attrs[keys] = argv[keys].strip()
+        self.dynamic_properties = set(["IndicatorLed", "PowerState"])
+        self.inventory_keys = set()
+        """Attrs set by the last set_inventory"""
+        self.set_inventory(argv)
+
+    def set_inventory(self, argv):
+        """Set the attrs read from the inventory, the ones the inventory no
+        longer has are removed"""
+        with self.lock:
+            inventory_keys = set()
+            for keys in argv.keys():
+                if keys is "UUID":
+                    uuid = argv[keys].split(':')
+                    if len(uuid) > 1:
+                        self.attrs[keys] = self.fancy_uuid(uuid[1])
+                        inventory_keys.add(keys)
+                else:
+                    self.attrs[keys] = argv[keys].strip()
+                    inventory_keys.add(keys)
+            for keys in self.inventory_keys - inventory_keys:
+                self.attrs.pop(keys, None)
+            self.inventory_keys = inventory_keys
 
     def fill_static_data(self):
         super(System, self).fill_static_data()
@@ -480,7 +997,7 @@ class System(RedfishBase):
                                       'BlinkFast',
                                       'BlinkSlow'])
         for children in self.child:
-            self.attrs[children.name] = dict([(ODATA_TYPE, children.path)])
+            self.attrs[children.name] = dict([(ODATA_ID, children.path)])
 
     def reset(self, op):
         self.provider.power_control(op)
@@ -490,10 +1007,12 @@ class System(RedfishBase):
 
     def fill_dynamic_data(self):
         super(System, self).fill_dynamic_data()
-        led_state = self.provider.led_operation('State', 'identify')
+        led_state, power_state = wait_all([
+            self.provider.led_operation_async('State', 'identify'),
+            self.provider.get_system_state_async()])
         if led_state is not None:
             self.attrs['IndicatorLed'] = led_state
-        self.attrs['PowerState'] = self.provider.get_system_state()
+        self.attrs['PowerState'] = power_state
 
 
 class EventService(RedfishBase):
@@ -510,8 +1029,93 @@ class EventService(RedfishBase):
 class EventDestinationCollection(RedfishCollectionBase):
     """Event Destination Collection class"""
 
-    def __init__(self, name):
+    def __init__(self, name, eventer):
         super(EventDestinationCollection, self).__init__(name)
+        self.namespace = "EventDestinationCollection"
+        self.version = "EventDestinationCollection"
+        self.eventer = eventer
+        self.next_id = 0
+
+    def load_subscriptions(self):
+        """Add the subscriptions of the eventer, call once the collection is
+        in the tree"""
+        for url, event in self.eventer.client_URI_endpoints.items():
+            s_name = str(event.attrs[EVENT_PROPS['ID']])
+            context = event.attrs[EVENT_PROPS['CONTEXT']]
+            self.add_child(EventDestination(s_name, url, context,
+                                            self.eventer))
+            if s_name.isdigit() and int(s_name) >= self.next_id:
+                self.next_id = int(s_name) + 1
+        self.eventer.removal_listener = self.subscription_removed
+
+    def subscription_removed(self, url):
+        for c in self.get_children():
+            if c.destination == url:
+                self.remove_child(c)
+                return
+
+    def del_req(self, op):
+        """Unsubscribe, the eventer and the collection change under the lock
+        so a POST sees both or neither"""
+        with self.lock:
+            subscription = self.get_child(op)
+            if subscription is not None:
+                try:
+                    self.eventer.remove_subscription(subscription.destination)
+                except KeyError:
+                    pass
+                self.remove_child(subscription)
+
+    def post_req(self, op):
+        """Subscribe the Destination of the request to the events, a
+        Destination is subscribed once"""
+        try:
+            destination = op.json["Destination"]
+        except KeyError:
+            return self.message_registry.get_error_message(
+                ERROR_REGISTRY_FILE_LOCATION,
+                "PropertyValueNotInList",
+                "Destination", "Destination is not provided")
+        context = op.json.get("Context", "")
+        with self.lock:
+            for c in self.child:
+                if c.destination == destination:
+                    return self.message_registry.get_error_message(
+                        ERROR_REGISTRY_FILE_LOCATION,
+                        "ResourceAlreadyExists", "EventDestination",
+                        "Destination", destination)
+            s_name = str(self.next_id)
+            self.next_id += 1
+            self.eventer.create_subscription(destination, s_name,
+                                             "Event Subscription", context)
+            subscription = EventDestination(s_name, destination, context,
+                                            self.eventer)
+            self.add_child(subscription)
+        return subscription.export_data()
+
+
+class EventDestination(RedfishBase):
+    """Subscription of a client to the events, the state of its delivery
+    queue is reported under Oem"""
+
+    def __init__(self, name, destination, context, eventer):
+        super(EventDestination, self).__init__(name)
+        self.namespace = "EventDestination"
+        self.version = "v1_0_2.EventDestination"
+        self.dynamic_properties = set(["Oem"])
+        self.destination = destination
+        self.eventer = eventer
+        self.attrs["Id"] = name
+        self.attrs["Name"] = "Event Subscription"
+        self.attrs["Destination"] = destination
+        self.attrs["Context"] = context
+        self.attrs["Protocol"] = "Redfish"
+
+    def fill_dynamic_data(self):
+        super(EventDestination, self).fill_dynamic_data()
+        stats = self.eventer.get_subscription_stats(self.destination)
+        if stats is not None:
+            self.attrs["Oem"] = {"OpenBMC": stats}
 
 
 class ErrorRegistryFile(EventService):
@@ -598,6 +1202,7 @@ class Power(RedfishBase):
         self.attrs["Id"] = name
         self.namespace = "Power"
         self.version = "v1_2_0.Power"
+        self.dynamic_properties = set(["PowerControl", "PowerSupplies"])
         self.powercontrol = []
         self.powersupplies = []
 
@@ -610,14 +1215,18 @@ class Power(RedfishBase):
 
     def fill_dynamic_data(self):
         super(Power, self).fill_dynamic_data()
-        self.attrs["PowerControl"] = []
-        self.attrs["PowerSupplies"] = []
+        power_control = []
+        power_supplies = []
         for p in self.powercontrol:
-            p.fill_dynamic_data()
-            self.attrs["PowerControl"].append(p.attrs)
+            with p.lock:
+                p.fill_dynamic_data()
+                power_control.append(dict(p.attrs))
         for p in self.powersupplies:
-            p.fill_dynamic_data()
-            self.attrs["PowerSupplies"].append(p.attrs)
+            with p.lock:
+                p.fill_dynamic_data()
+                power_supplies.append(dict(p.attrs))
+        self.attrs["PowerControl"] = power_control
+        self.attrs["PowerSupplies"] = power_supplies
 
 
 class Thermal(RedfishBase):
@@ -703,9 +1312,9 @@ class SessionService(RedfishBase):
         self.attrs["Status"] = {"State": "Enabled",
                                 "Health": "Ok"}
         self.attrs["ServiceEnabled"] = "true"
-        self.attrs["SessionTimeout"] = "30"
+        self.attrs["SessionTimeout"] = SESSION_TIMEOUT_SECONDS
         for children in self.child:
-            self.attrs[children.name] = dict([(ODATA_TYPE, children.path)])
+            self.attrs[children.name] = dict([(ODATA_ID, children.path)])
 
 
 class SessionCollection(RedfishCollectionBase):
@@ -716,28 +1325,42 @@ class SessionCollection(RedfishCollectionBase):
         self.instance_id = instance_id
         self.namespace = "SessionCollection"
         self.version = "v1_0_2.SessionCollection"
+        self.store = SessionStore()
+        """Open sessions by id and by token, closes idle sessions"""
+        self.store.removal_listener = self.session_expired
+        self.store.start()
+        self.credentials = CredentialCache()
+        """Passwords checked lately, spares a crypt per login"""
 
     def fill_static_data(self):
         super(SessionCollection, self).fill_static_data()
         self.attrs["Name"] = self.instance_id
 
+    def fill_dynamic_data(self):
+        super(SessionCollection, self).fill_dynamic_data()
+        self.store.expire()
+
+    def session_expired(self, record):
+        session = self.get_child(str(record.session_id))
+        if session is not None:
+            self.remove_child(session)
+
+    def find_session(self, token):
+        """Returns the Session of the token and keeps it open, or None"""
+        record = self.store.lookup(token)
+        if record is None:
+            return None
+        return self.get_child(str(record.session_id))
+
     def authenticate(self, username, clear):
-        try:
-            encoded = spwd.getspnam(username)[1]
-            return encoded == crypt.crypt(clear, encoded)
-        except KeyError:
-            return False
+        return self.credentials.authenticate(username, clear)
 
     def del_req(self, op):
-        for c in self.child:
-            if op == c.name:
-                i = 0
-                for k in self.attrs["Members"]:
-                    if k[ODATA_ID] == c.path:
-                        del self.attrs["Members"][i]
-                        print "deleted"
-                        self.attrs["Members@odata.count"] -= 1
-                    i = i+1
+        with self.lock:
+            session = self.get_child(op)
+            if session is not None:
+                self.store.remove(session.session_id)
+                self.remove_child(session)
 
     def post_req(self, op):
         """Perfrom the requested action and return the information"""
@@ -764,22 +1387,23 @@ class SessionCollection(RedfishCollectionBase):
                 "Password", "Password and username does not match")
         else:
             """create a session login"""
-            print "Login Successful"
-            if self.static_data_filled == 0:
-                self.fill_static_data()
-            ret = {}
-            rand = int(os.urandom(64).encode('hex'), 16)
-            s_name = str(len(self.child))
-            session = Session(s_name, uname)
-            session.key = rand
-            self.add_child(session)
-            self.attrs["Members"].append(dict([(ODATA_ID, session.path)]))
-            session.attrs["Location"] = session.path
-            session.attrs["X-Auth-Token"] = rand
-            ret = session.get_export_data(s_name)
-            del session.attrs["Location"]
-            del session.attrs["X-Auth-Token"]
-            return ret
+            record = self.store.create(uname)
+            if record is None:
+                return self.message_registry.get_error_message(
+                    ERROR_REGISTRY_FILE_LOCATION, "SessionLimitExceeded")
+            with self.lock:
+                if self.static_data_filled == 0:
+                    self.fill_static_data()
+                    self.static_data_filled = 1
+                session = Session(str(record.session_id), uname)
+                session.session_id = record.session_id
+                self.add_child(session)
+            """the token is only part of this response, never of the attrs
+            other requests can read"""
+            ret = session.export_attrs()
+            ret["Location"] = session.path
+            ret["X-Auth-Token"] = record.token
+            return json.dumps(ret)
 
 
 class Session(RedfishBase):
@@ -790,6 +1414,8 @@ class Session(RedfishBase):
         self.namespace = "Session"
         self.version = "v1_0_2.Session"
         self.user = user
+        self.session_id = None
+        """Id of the session in the session store"""
 
     def fill_static_data(self):
         super(Session, self).fill_static_data()
@@ -801,14 +1427,40 @@ class Session(RedfishBase):
 class RedfishBottleRoot(object):
     """Class that contains and builds the resource tree"""
 
-    def __init__(self):
-        """Build the resource tree in a top-down fashion"""
-        self.provider = ObmcRedfishProviders()
+    def __init__(self, provider=None, lazy=True, eventer=None):
+        """Build the resource tree in a top-down fashion, on the providers of
+        the system bus unless a provider is given. The subtrees made from the
+        inventory are built by the startup pipeline or on first use if lazy,
+        the pipeline is waited for otherwise"""
+        self.provider = provider
+        if provider is None:
+            self.provider = ObmcRedfishProviders()
 
-        self.eventer = Eventer(False, 3, 5)
+        self.eventer = eventer
+        if eventer is None:
+            self.eventer = Eventer(False, 3, 5)
 
         self.root = RedfishRoot("redfish", self.provider)
 
+        self.path_index = self.root.path_index
+        """Every resource of the tree keyed by path, see path_key"""
+
+        self.documents = {}
+        """Documents about the whole tree, key = path, value = generation of
+        the tree and RedfishEntity"""
+
+        self.request_histograms = {}
+        """Histograms of the requests seen lately, key = method and path,
+        see request_histogram"""
+
+        self.histograms_generation = None
+
+        self.lazy_subtrees = []
+        """LazySubtrees not built yet, replaced rather than changed in place
+        so it can be read without the lock"""
+
+        self.lazy_subtrees_lock = threading.Lock()
+
         self.v1 = ServiceRoot("v1", "RootService")
         self.root.add_child(self.v1)
 
@@ -828,54 +1480,11 @@ class RedfishBottleRoot(object):
                                                   "Computer System Collection")
         self.v1.add_child(self.system_collection)
 
-        self.chassis_info = self.provider.get_chassis_info()
-
-        self.system = System(self.chassis_info['SerialNumber'],
-                             self.chassis_info)
-
-        self.system_collection.add_child(self.system)
-
-        self.chassis = Chassis("1U", self.chassis_info)
-
-        self.chassis_collection.add_child(self.chassis)
+        self.inventory_subtree = self.add_lazy_subtree(
+            [self.system_collection, self.chassis_collection],
+            self.build_inventory)
 
-        self.chassis.add_related_object("ComputerSystems", self.system)
-
-        self.processors = ProcessorCollection("Processors",
-                                              "Processors Collection")
-
-        self.system.add_child(self.processors)
-
-        self.memories = MemoryCollection("Memory",
-                                         "Memory Collection")
-
-        self.system.add_child(self.memories)
-
-        self.processor_list = []
-
-        self.processor_dict = self.provider.get_cpu_info()
-
-        self.index = 0
-
-        for keys in self.processor_dict.keys():
-            self.processor_list.append(Processor(keys,
-                                       self.processor_dict[keys]))
-            self.processors.add_child(self.processor_list[self.index])
-            self.index = self.index + 1
-
-        self.index = 0
-
-        self.memory_list = []
-
-        self.memory_dict = self.provider.get_dimm_info()
-
-        for keys in self.memory_dict.keys():
-            self.memory_list.append(Memory(keys,
-                                    self.memory_dict[keys]))
-            self.memories.add_child(self.memory_list[self.index])
-            self.index = self.index + 1
-
-        self.index = 0
+        self.provider.inventory_listeners.append(self.inventory_changed)
 
         self.registries = Registries("Base Message Registry File")
 
@@ -886,10 +1495,13 @@ class RedfishBottleRoot(object):
         self.v1.add_child(self.event_service)
 
         self.event_destination_collection = \
-            EventDestinationCollection("Event Subscriptions Collection")
+            EventDestinationCollection("Event Subscriptions Collection",
+                                       self.eventer)
 
         self.event_service.add_child(self.event_destination_collection)
 
+        self.event_destination_collection.load_subscriptions()
+
         self.registry_file_collection = \
             RegistryFileCollection("Registry Files Collection")
 
@@ -901,6 +1513,36 @@ class RedfishBottleRoot(object):
 
         self.registry_file_collection.add_child(self.error_registry_file)
 
+        self.startup = StartupPipeline()
+        """Provider queries that do not depend on each other run at the same
+        time, the resources are attached as their data arrives"""
+
+        self.startup.add('inventory', self.load_inventory)
+        self.startup.add('service_root', self.v1.export_entity)
+        self.startup.add('systems', self.populate_inventory, ['inventory'])
+        self.startup.run()
+        if lazy is False:
+            self.startup.wait()
+
+    def build_inventory(self):
+        """Build the systems and the chassis, the enumeration of the
+        inventory behind get_chassis_info takes most of the startup. All the
+        provider data is read before a node is added, a build that fails
+        leaves the tree as it was"""
+        self.chassis_info = self.provider.get_chassis_info()
+
+        self.processor_dict = self.provider.get_cpu_info()
+
+        self.memory_dict = self.provider.get_dimm_info()
+
+        self.build_system()
+
+        self.chassis = Chassis("1U", self.chassis_info)
+
+        self.chassis_collection.add_child(self.chassis)
+
+        self.chassis.add_related_object("ComputerSystems", self.system)
+
         self.thermal = Thermal("Thermal")
 
         self.chassis.add_child(self.thermal)
@@ -917,15 +1559,138 @@ class RedfishBottleRoot(object):
         self.power.add_child(self.power_control)
         self.power.add_child(self.power_supplies_0)
         self.power.add_child(self.power_supplies_1)
-#       Experimental code for sensors. Would remove this later
-#        self.provider.get_fan_speed()
-        for sensors in SENSORS_INFO.keys():
-            value = self.provider.get_sensors(sensors)
-            print_dict("", value)
+
+    def build_system(self):
+        """Build the system of chassis_info with its processors and memory,
+        its Id is the serial number"""
+        self.system = System(self.chassis_info['SerialNumber'],
+                             self.chassis_info)
+
+        self.system_collection.add_child(self.system)
+
+        self.processors = ProcessorCollection("Processors",
+                                              "Processors Collection")
+
+        self.system.add_child(self.processors)
+
+        self.memories = MemoryCollection("Memory",
+                                         "Memory Collection")
+
+        self.system.add_child(self.memories)
+
+        self.processor_list = []
+
+        self.index = 0
+
+        for keys in self.processor_dict.keys():
+            self.processor_list.append(Processor(
+                keys, dict(self.processor_dict[keys])))
+            self.processors.add_child(self.processor_list[self.index])
+            self.index = self.index + 1
+
+        self.index = 0
+
+        self.memory_list = []
+
+        for keys in self.memory_dict.keys():
+            self.memory_list.append(Memory(keys,
+                                    dict(self.memory_dict[keys])))
+            self.memories.add_child(self.memory_list[self.index])
+            self.index = self.index + 1
+
+        self.index = 0
+
+    def replace_system(self):
+        """A new serial number moves the system to another path. The old
+        system is removed with its subtree, from the index and the Members
+        of the systems too, and a new one is built"""
+        old_system = self.system
+        self.system_collection.remove_child(old_system)
+        self.chassis.remove_related_object("ComputerSystems", old_system)
+        self.build_system()
+        self.chassis.add_related_object("ComputerSystems", self.system)
+
+    def inventory_changed(self, paths):
+        """Bring the inventory subtrees up to date with the inventory objects
+        that changed after they were built, nothing to do if they were not"""
+        subtree = self.inventory_subtree
+        with subtree.lock:
+            if subtree.built is False:
+                return
+            chassis_info = self.provider.get_chassis_info()
+            processor_dict = self.provider.get_cpu_info()
+            memory_dict = self.provider.get_dimm_info()
+            self.chassis.set_inventory(chassis_info)
+            serial = chassis_info.get('SerialNumber')
+            if serial is not None and serial != self.system.name:
+                self.chassis_info = chassis_info
+                self.processor_dict = processor_dict
+                self.memory_dict = memory_dict
+                self.replace_system()
+                return
+            self.system.set_inventory(chassis_info)
+            self.chassis_info = chassis_info
+            self.update_members(self.processors, self.processor_dict,
+                                processor_dict, Processor)
+            self.processor_dict = processor_dict
+            self.update_members(self.memories, self.memory_dict,
+                                memory_dict, Memory)
+            self.memory_dict = memory_dict
+
+    def update_members(self, collection, old, new, member_class):
+        """Replace, add or remove the members whose inventory info differs
+        between old and new, key = name of the member"""
+        for name in old.keys():
+            if new.get(name) != old[name]:
+                child = collection.get_child(name)
+                if child is not None:
+                    collection.remove_child(child)
+        for name in new.keys():
+            if old.get(name) != new[name]:
+                collection.add_child(member_class(name, dict(new[name])))
+
+    def add_lazy_subtree(self, nodes, build):
+        subtree = LazySubtree([n.path for n in nodes], build)
+        with self.lazy_subtrees_lock:
+            self.lazy_subtrees = self.lazy_subtrees + [subtree]
+        return subtree
+
+    def populate(self, key, descendants=False):
+        """Build the lazy subtrees the resource at key is in, or with
+        descendants also the ones under it"""
+        for subtree in self.lazy_subtrees:
+            if subtree.covers(key, descendants) is True:
+                subtree.populate()
+        with self.lazy_subtrees_lock:
+            self.lazy_subtrees = [s for s in self.lazy_subtrees
+                                  if s.built is False]
+
+    def populate_all(self):
+        self.populate("/", descendants=True)
+
+    def load_inventory(self):
+        if self.provider.get_inventory_index() is None:
+            raise RuntimeError("the inventory could not be read")
+
+    def populate_inventory(self):
+        if self.inventory_subtree.populate() is False:
+            raise RuntimeError("the inventory subtrees could not be built")
 
     def print_all(self):
+        self.populate_all()
         self.root.print_all()
 
+    def get_cached_document(self, key, build):
+        """Returns the RedfishEntity made by build, cached until the shape of
+        the tree changes"""
+        generation = self.path_index.generation
+        cached = self.documents.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        entity = build()
+        self.documents[key] = (generation, entity)
+        return entity
+
     def get_odata_document(self):
         q = []
         document = {}
@@ -935,22 +1700,173 @@ class RedfishBottleRoot(object):
         while len(q):
             children = q.pop(-1)
             document['value'].append(children.get_document())
-            for subchild in children.child:
-                q.append(subchild)
+            q.extend(children.get_children())
         return json.dumps(document)
 
+    def get_metadata_document(self):
+        """Returns the CSDL document with a reference to the schema of every
+        namespace registered in the tree"""
+        references = {}
+        q = [self.root]
+        while len(q):
+            node = q.pop(-1)
+            namespaces = node.get_schema_namespaces()
+            if len(namespaces):
+                references.setdefault(namespaces[0], set()).update(namespaces)
+            q.extend(node.get_children())
+
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<edmx:Edmx xmlns:edmx="%s" Version="4.0">' % EDMX_NAMESPACE]
+        for namespace in sorted(references.keys()):
+            lines.append('  <edmx:Reference Uri="%s/%s_v1.xml">' %
+                         (REDFISH_SCHEMA_WEB_LINK, namespace))
+            for include in sorted(references[namespace]):
+                lines.append('    <edmx:Include Namespace="%s"/>' % include)
+            lines.append('  </edmx:Reference>')
+        lines.append('  <edmx:DataServices>')
+        lines.append('    <Schema xmlns="%s" Namespace="Service">' %
+                     EDM_NAMESPACE)
+        lines.append('      <EntityContainer Name="Service" '
+                     'Extends="%s.ServiceContainer"/>' %
+                     self.v1.get_schema_namespaces()[-1])
+        lines.append('    </Schema>')
+        lines.append('  </edmx:DataServices>')
+        lines.append('</edmx:Edmx>')
+        return "\n".join(lines) + "\n"
+
+    def find_resource(self, path):
+        """Returns the resource at the split path, or None. The lazy subtree
+        the path is in is built first"""
+        key = path_key(path)
+        if len(self.lazy_subtrees):
+            self.populate(key)
+        return self.path_index.get(key)
+
+    def authorize(self, token):
+        """Keeps the session of the X-Auth-Token of a request open. Returns
+        None, or the RedfishEntity of the error if the token is of no open
+        session. Requests without a token are not refused"""
+        if token is None:
+            return None
+        if self.session_collection.find_session(token) is not None:
+            return None
+        return RedfishEntity(self.root.message_registry.get_error_message(
+                ERROR_REGISTRY_FILE_LOCATION, "NoValidSession"),
+                error=True, status=401)
+
+    def request_histogram(self, method, path):
+        """Returns the histogram a request is recorded in. Requests are
+        counted under the class of the resource rather than its path, which
+        keeps the number of routes small. The histogram is cached per method
+        and path for the tree generation, a lookup on every request would
+        cost more than the recording"""
+        generation = self.path_index.generation
+        if (self.histograms_generation != generation or
+                len(self.request_histograms) > 1024):
+            self.request_histograms = {}
+            self.histograms_generation = generation
+        histogram = self.request_histograms.get((method, path))
+        if histogram is None:
+            route = self.find_route(path_segments(path.split('/')))
+            histogram = REQUEST_SECONDS.labels(method, route)
+            self.request_histograms[(method, path)] = histogram
+        return histogram
+
+    def find_route(self, path):
+        """Returns the route of the split path, see request_histogram"""
+        key = path_key(path)
+        if key == '/redfish/v1/odata':
+            return 'odata'
+        elif key == '/redfish/v1/$metadata':
+            return '$metadata'
+        elif len(path) > 2 and path[-2] == 'Actions':
+            node = self.find_resource(path[:-2])
+            if node is not None:
+                return node.__class__.__name__ + '.Actions'
+        node = self.find_resource(path)
+        if node is None:
+            return 'NotFound'
+        return node.__class__.__name__
+
     def get_json(self, path):
-        if len(path) == 3 and path[0] == 'redfish' \
-                and path[1] == 'v1' and path[2] == '$metadata':
-                    return self.get_odata_document()
-        else:
-            return self.root.get_export_data(path)
+        return self.get_entity(path).body
+
+    def get_entity(self, path, query={}):
+        """Returns the RedfishEntity for a get request on the split path,
+        query holds the parameters of the request"""
+        key = path_key(path)
+        if key == '/redfish/v1/odata':
+            self.populate_all()
+            return self.get_cached_document(
+                key, lambda: RedfishEntity(self.get_odata_document()))
+        elif key == '/redfish/v1/$metadata':
+            self.populate_all()
+            return self.get_cached_document(
+                key, lambda: RedfishEntity(self.get_metadata_document(),
+                                           content_type=XML_CONTENT_TYPE))
+        node = self.find_resource(path)
+        if node is None:
+            return RedfishEntity(self.root.get_export_data(path), error=True)
+        for parameter in QUERY_PARAMETERS:
+            if query.get(parameter) is not None:
+                return self.get_query_entity(node, query)
+        return node.export_entity()
+
+    def query_error(self, query, parameter):
+        return RedfishEntity(self.root.message_registry.get_error_message(
+                ERROR_REGISTRY_FILE_LOCATION, "QueryParameterValueFormatError",
+                query.get(parameter), parameter), error=True, status=400)
+
+    def get_query_entity(self, node, query):
+        """Returns the RedfishEntity of the node with the query options
+        applied. Members are paged before they are expanded, properties are
+        selected before the document is encoded"""
+        expand = select = top = skip = None
+        if query.get('$expand') is not None:
+            expand = parse_expand(query.get('$expand'))
+            if expand is None:
+                return self.query_error(query, '$expand')
+        if query.get('$select') is not None:
+            select = parse_select(query.get('$select'))
+            if select is None:
+                return self.query_error(query, '$select')
+        for parameter in ('$top', '$skip'):
+            if query.get(parameter) is not None:
+                if parse_count(query.get(parameter)) is None:
+                    return self.query_error(query, parameter)
+        top = parse_count(query.get('$top'))
+        skip = parse_count(query.get('$skip'))
+
+        properties = None
+        if select is not None:
+            properties = set(path[0] for path in select)
+        document = node.export_attrs(properties)
+        if (top is not None or skip is not None) and "Members" in document:
+            document = page_members(document, node.path, top, skip, query)
+        if select is not None:
+            document = select_attrs(document, select)
+        if expand is not None:
+            self.populate(node.path, descendants=True)
+            request = ExpandRequest(self.path_index, expand[0], expand[1])
+            document = request.expand(document)
+        return RedfishEntity(json.dumps(document))
 
     def do_action(self, path, obj):
-        return self.root.action(path, obj)
+        path = path_segments(path)
+        node = self.find_resource(path[:-2])
+        if node is None:
+            return self.root.action(path, obj)
+        return node.do_action(path[-2:], obj)
 
     def do_post(self, path, obj):
-        return self.root.post_data(path, obj)
+        node = self.find_resource(path)
+        if node is None:
+            return self.root.post_data(path, obj)
+        return node.post_req(obj)
 
     def do_delete(self, path, obj):
-        return self.root.del_data(path, obj)
+        path = path_segments(path)
+        node = self.find_resource(path[:-1])
+        if node is None or node.get_child(path[-1]) is None:
+            return self.root.del_data(path, obj)
+        return node.del_req(path[-1])
@@ -2,12 +2,54 @@
 
 import sys
 import os
+import time
 import logging
+import argparse
 from bottle import Bottle, abort, request, response, JSONPlugin, HTTPError
+from bottle import HTTPResponse
 from redfish_resource import *
+from redfish_metrics import *
 from rocket import Rocket
 
 
+WILDCARD_CODINGS = ('gzip', 'deflate')
+"""Content codings a '*' of Accept-Encoding stands for, most preferred
+first"""
+
+
+def accepted_codings(accept_encoding):
+    """Returns the content codings of an Accept-Encoding header value, most
+    preferred first. Codings with q=0 are left out, '*' stands for the
+    WILDCARD_CODINGS the value does not name"""
+    if accept_encoding is None:
+        return []
+    codings = []
+    named = set()
+    wildcard = None
+    for i, item in enumerate(accept_encoding.split(',')):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding == '*':
+            wildcard = (quality, i)
+            continue
+        named.add(coding)
+        if coding and quality > 0:
+            codings.append((-quality, i, 0, coding))
+    if wildcard is not None and wildcard[0] > 0:
+        for rank, coding in enumerate(WILDCARD_CODINGS):
+            if coding not in named:
+                codings.append((-wildcard[0], wildcard[1], rank, coding))
+    return [coding for _, _, _, coding in sorted(codings)]
+
+
 class RouteHandler(object):
 
     def __init__(self, app, verbs, rules, redfish):
@@ -26,7 +68,19 @@ class RouteHandler(object):
                 405, "Method not allowed.", Allow=','.join(self._verbs))
 
     def __call__(self, **kw):
-        return getattr(self, 'do_' + request.method.lower())(**kw)
+        """The histogram is looked up before the request is handled, the
+        resource of a DELETE is gone afterwards"""
+        method = request.method
+        histogram = None
+        if METRICS.enabled is True:
+            histogram = self.redfish.request_histogram(
+                method, kw.get('path', '/'))
+        start = time.time()
+        try:
+            return getattr(self, 'do_' + method.lower())(**kw)
+        finally:
+            if histogram is not None:
+                histogram.observe(time.time() - start)
 
     def install(self):
         self.app.route(
@@ -52,34 +106,72 @@ class GetRequestHandler(RouteHandler):
     def find(self, path='/'):
         """provide the path to redfish build tree and get a response"""
         path_list = path.split('/')
-        server_data = self.redfish.get_json(path_list)
-        if self.is_error(server_data) is True:
-            raise HTTPError(404, server_data)
-        else:
-            return server_data
+        entity = self.redfish.get_entity(path_list, request.query)
+        if entity.error is True:
+            raise HTTPError(entity.status, entity.body)
+        coding = entity.select_coding(
+            accepted_codings(request.headers.get('Accept-Encoding')))
+        if entity.match(request.headers.get('If-None-Match'), coding):
+            raise HTTPResponse(status=304, ETag=entity.get_etag(coding),
+                               Vary='Accept-Encoding')
+        response.set_header('ETag', entity.get_etag(coding))
+        response.set_header('Vary', 'Accept-Encoding')
+        if coding is not None:
+            response.set_header('Content-Encoding', coding)
+        response.content_type = entity.content_type
+        return entity.get_body(coding)
 
     def setup(self, path='/'):
         request.route_data['map'] = self.find(path)
 
+    def authorize(self):
+        """Refuse a request with the token of no open session, the session
+        of a valid token is kept open"""
+        entity = self.redfish.authorize(request.headers.get('X-Auth-Token'))
+        if entity is not None:
+            raise HTTPError(entity.status, entity.body)
+
     def do_get(self, path='/'):
+        self.authorize()
         return self.find(path)
 
     def find_post(self, path='/'):
         """provide the path to redfish build tree and get a response"""
-        path_list = path.split('/')
-        if(len(path) > 3 and path[-2] == 'Actions'):
+        path_list = path_segments(path.split('/'))
+        if(len(path_list) > 3 and path_list[-2] == 'Actions'):
             return self.redfish.do_action(path_list, request)
         else:
             return self.redfish.do_post(path_list, request)
 
     def do_post(self, path):
+        self.authorize()
         return self.find_post(path)
 
     def do_delete(self, path):
+        self.authorize()
         path_list = path.split('/')
         return self.redfish.do_delete(path_list, request)
 
 
+class MetricsHandler(object):
+    """Serves the metrics to clients on the loopback interface only"""
+
+    loopback = ['127.0.0.1', '::1', '::ffff:127.0.0.1']
+    rules = '/metrics'
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self):
+        if request.environ.get('REMOTE_ADDR') not in self.loopback:
+            raise HTTPError(403, "Metrics are served on loopback only.")
+        response.content_type = PROMETHEUS_CONTENT_TYPE
+        return METRICS.render()
+
+    def install(self):
+        self.app.route(self.rules, callback=self, method=['GET'])
+
+
 class RedfishServer(Bottle):
 
     def __init__(self, root):
@@ -90,12 +182,21 @@ class RedfishServer(Bottle):
 
     def create_handlers(self):
         self.get_request_handler = GetRequestHandler(self, self.redfish_root)
+        self.metrics_handler = MetricsHandler(self)
 
     def install_handlers(self):
+        self.metrics_handler.install()
         self.get_request_handler.install()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OpenBMC Redfish server")
+    parser.add_argument('--min-threads', type=int, default=4,
+                        help="worker threads kept ready for requests")
+    parser.add_argument('--max-threads', type=int, default=16,
+                        help="upper limit of worker threads")
+    args = parser.parse_args()
+
     log = logging.getLogger('Rocket.Errors')
     log.setLevel(logging.INFO)
     log.addHandler(logging.StreamHandler(sys.stdout))
@@ -108,7 +209,7 @@ if __name__ == '__main__':
     server = Rocket(
         ('0.0.0.0', 8080, default_cert, default_cert),
         'wsgi', {'wsgi_app': app},
-        min_threads=1,
-        max_threads=1)
+        min_threads=args.min_threads,
+        max_threads=args.max_threads)
     print "Starting Server"
     server.start()
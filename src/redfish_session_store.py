@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+
+# Description : Store of the login sessions with idle timeout
+
+import os
+import gc
+import time
+import resource
+import threading
+
+SESSION_TIMEOUT_SECONDS = 1800
+"""Idle time after which a session is closed, every request carrying the
+token of the session moves it on"""
+
+MAX_SESSIONS = 64
+"""Sessions open at the same time, logins beyond it are refused"""
+
+EXPIRY_RESOLUTION_SECONDS = 1.0
+"""Length of one slot of the timer wheel"""
+
+
+class SessionRecord(object):
+    """One open session"""
+
+    def __init__(self, session_id, token, user, expires):
+        self.session_id = session_id
+        self.token = token
+        self.user = user
+        self.expires = expires
+        """Time the session expires at, moved on by every use"""
+        self.slot = None
+        """Slot of the timer wheel the record is in"""
+
+
+class SessionStore(object):
+    """
+    Sessions indexed by id and by token. Every session sits in one slot of a
+    timer wheel, the slot of the tick it expires at. A use of the session
+    only moves expires on, the record is moved to its new slot when the
+    wheel reaches the old one. Expired sessions are removed on lookup and by
+    a thread that turns the wheel once per tick
+    """
+
+    def __init__(self, timeout=SESSION_TIMEOUT_SECONDS,
+                 max_sessions=MAX_SESSIONS,
+                 resolution=EXPIRY_RESOLUTION_SECONDS, clock=time.time):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.resolution = resolution
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.sessions = {}
+        """Open sessions, key = session id"""
+        self.tokens = {}
+        """Open sessions, key = token"""
+        self.last_id = 0
+        """Ids are never reused, a new session gets last_id + 1"""
+        self.slots = [set() for _ in
+                      range(int(timeout / resolution) + 2)]
+        self.tick = self.tick_of(clock())
+        """Last tick the wheel was turned to"""
+        self.removal_listener = None
+        """Called with the record of every session that expired"""
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="SessionExpiry")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.resolution)
+            self.expire()
+
+    def tick_of(self, when):
+        return int(when / self.resolution)
+
+    def place(self, record):
+        """Put the record in the slot of the tick it expires at, call with
+        the lock held"""
+        slot = self.tick_of(record.expires) % len(self.slots)
+        if record.slot != slot:
+            if record.slot is not None:
+                self.slots[record.slot].discard(record.session_id)
+            self.slots[slot].add(record.session_id)
+            record.slot = slot
+
+    def drop(self, record):
+        """Remove the record from the indexes, call with the lock held"""
+        del self.sessions[record.session_id]
+        del self.tokens[record.token]
+        self.slots[record.slot].discard(record.session_id)
+
+    def create(self, user):
+        """Open a session for the user, returns its record or None when
+        max_sessions are open"""
+        self.expire()
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                return None
+            self.last_id += 1
+            token = os.urandom(32).encode('hex')
+            record = SessionRecord(self.last_id, token, user,
+                                   self.clock() + self.timeout)
+            self.sessions[record.session_id] = record
+            self.tokens[token] = record
+            self.place(record)
+        return record
+
+    def lookup(self, token):
+        """Returns the record of the open session with the token and moves
+        its expiry on, or None"""
+        expired = None
+        with self.lock:
+            record = self.tokens.get(token)
+            if record is None:
+                return None
+            now = self.clock()
+            if record.expires <= now:
+                self.drop(record)
+                expired = record
+            else:
+                record.expires = now + self.timeout
+        if expired is not None:
+            self.notify([expired])
+            return None
+        return record
+
+    def get(self, session_id):
+        """Returns the record of the session with the id, or None"""
+        return self.sessions.get(session_id)
+
+    def remove(self, session_id):
+        """Close the session, returns its record or None if it was not
+        open"""
+        with self.lock:
+            record = self.sessions.get(session_id)
+            if record is not None:
+                self.drop(record)
+        return record
+
+    def expire(self):
+        """Turn the wheel over the ticks that passed, removing the sessions
+        that expired. Returns their records"""
+        expired = []
+        with self.lock:
+            now = self.clock()
+            last = self.tick_of(now) - 1
+            ticks = min(last - self.tick, len(self.slots))
+            for tick in range(last - ticks + 1, last + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for session_id in list(slot):
+                    record = self.sessions[session_id]
+                    if record.expires <= now:
+                        self.drop(record)
+                        expired.append(record)
+                    else:
+                        self.place(record)
+            self.tick = max(self.tick, last)
+        self.notify(expired)
+        return expired
+
+    def notify(self, expired):
+        """Tell the listener about the expired sessions, outside the lock so
+        the listener may take its own locks"""
+        if self.removal_listener is not None:
+            for record in expired:
+                self.removal_listener(record)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+if __name__ == '__main__':
+    cycles = 1000000
+    now = [0.0]
+    store = SessionStore(timeout=30, clock=lambda: now[0])
+    gc.collect()
+    start = time.time()
+    for i in xrange(cycles):
+        record = store.create('root')
+        store.lookup(record.token)
+        if i % 2 == 0:
+            store.remove(record.session_id)
+        now[0] += 0.5
+        if i % (cycles / 10) == 0:
+            print "%8d cycles  open %3d  maxrss %6d KiB" % (
+                i, len(store), resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss)
+    print "%d login/logout cycles, half left to expire : %.1f s" % (
+        cycles, time.time() - start)
+    now[0] += store.timeout + EXPIRY_RESOLUTION_SECONDS
+    store.expire()
+    print "open after the timeout : %d, tokens %d, slotted %d" % (
+        len(store), len(store.tokens), sum(len(s) for s in store.slots))
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+
+# Description : Stages of the startup of the service run as soon as the
+#               stages they depend on are done
+
+import time
+import threading
+
+
+class StartupStage(object):
+    """One step of the startup and its timing"""
+
+    def __init__(self, name, function, depends):
+        self.name = name
+        self.function = function
+        self.depends = depends
+        """Stages that must be done before this one starts"""
+        self.launched = False
+        self.started = None
+        self.finished = None
+        self.failed = False
+        self.skipped = False
+        """Not run because a stage it depends on failed or was skipped"""
+        self.done = threading.Event()
+
+
+class StartupPipeline(object):
+    """
+    Stages of the startup, each run on a thread of its own as soon as the
+    stages it depends on are done, so the provider queries that do not
+    depend on each other wait on D-Bus at the same time. A stage whose
+    dependency failed is skipped. The start and the duration of every stage
+    are printed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+        self.start = None
+        self.finished = None
+
+    def add(self, name, function, depends=()):
+        """Add a stage running function after the stages named in depends,
+        which must have been added before"""
+        stages = dict((stage.name, stage) for stage in self.stages)
+        stage = StartupStage(name, function,
+                             [stages[depend] for depend in depends])
+        self.stages.append(stage)
+        return stage
+
+    def run(self):
+        """Launch the stages that depend on none, returns at once"""
+        self.start = time.time()
+        self.launch_ready()
+
+    def launch_ready(self):
+        """Run, or skip, the stages whose dependencies are all done"""
+        with self.lock:
+            ready = [stage for stage in self.stages
+                     if stage.launched is False and
+                     all(d.done.is_set() for d in stage.depends)]
+            for stage in ready:
+                stage.launched = True
+        for stage in ready:
+            if any(d.failed or d.skipped for d in stage.depends):
+                stage.skipped = True
+                print "startup stage %-14s skipped" % stage.name
+                self.finish(stage)
+            else:
+                thr = threading.Thread(target=self.run_stage, args=(stage,),
+                                       name="Startup-" + stage.name)
+                thr.daemon = True
+                thr.start()
+
+    def run_stage(self, stage):
+        stage.started = time.time()
+        try:
+            stage.function()
+        except Exception as e:
+            stage.failed = True
+            print "startup stage %-14s failed: %s" % (stage.name, e)
+        stage.finished = time.time()
+        print "startup stage %-14s at %8.1f ms took %8.1f ms" % (
+            stage.name, (stage.started - self.start) * 1000,
+            (stage.finished - stage.started) * 1000)
+        self.finish(stage)
+
+    def finish(self, stage):
+        """Mark the stage done, the end of the startup is recorded before the
+        last stage is marked so it is there when wait returns"""
+        with self.lock:
+            complete = (self.finished is None and
+                        all(s.done.is_set() or s is stage
+                            for s in self.stages))
+            if complete is True:
+                self.finished = time.time()
+                print "startup complete in %.1f ms" % (
+                    (self.finished - self.start) * 1000)
+            stage.done.set()
+        if complete is False:
+            self.launch_ready()
+
+    def wait(self, timeout=None):
+        """Wait for all the stages, returns False on timeout"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for stage in self.stages:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            if not stage.done.wait(remaining):
+                return False
+        return True
+
+
+if __name__ == '__main__':
+    queries = [('inventory', 0.2, ()), ('sensors', 0.1, ()),
+               ('system_id', 0.05, ()), ('systems', 0.02, ('inventory',))]
+    start = time.time()
+    for name, seconds, depends in queries:
+        time.sleep(seconds)
+    serial = time.time() - start
+    pipeline = StartupPipeline()
+    for name, seconds, depends in queries:
+        pipeline.add(name, lambda seconds=seconds: time.sleep(seconds),
+                     depends)
+    pipeline.run()
+    pipeline.wait()
+    print "one after another : %.1f ms, pipeline : %.1f ms" % (
+        serial * 1000, (pipeline.finished - pipeline.start) * 1000)
@@ -0,0 +1,194 @@
+#! /usr/bin/env python
+
+# Description : Append-only journal of the event subscriptions
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+"""
+Journal Records, one JSON object per line
+"""
+RECORD_ADD = 'add'
+RECORD_REMOVE = 'remove'
+
+COMPACT_MIN_RECORDS = 64
+"""Records in the journal before it is worth compacting"""
+
+
+def fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SubscriptionJournal(object):
+    """
+    Persists the subscriptions as add and remove records appended to a
+    journal file. The journal is compacted in the background into one add
+    record per live subscription, written to a temporary file, synced and
+    renamed over the journal
+    """
+
+    def __init__(self, path, compact_min_records=COMPACT_MIN_RECORDS):
+        self.path = path
+        self.compact_min_records = compact_min_records
+        self.lock = threading.Lock()
+        self.live = {}
+        """Subscriptions in the journal, key=url, value=attrs"""
+        self.records = 0
+        """Records in the journal file"""
+        self.journal_file = None
+        self.compacting = False
+
+    def replay(self):
+        """
+        Reads the journal and returns the live subscriptions. A torn record
+        at the end of the file, left by a crash during an append, is cut off
+        """
+        self.live = {}
+        self.records = 0
+        good_size = 0
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as journal:
+                for line in journal:
+                    if not line.endswith('\n'):
+                        print 'dropping torn journal record'
+                        break
+                    try:
+                        record = json.loads(line)
+                        self.apply(record)
+                    except (ValueError, KeyError, TypeError) as e:
+                        print 'skipping bad journal record', e
+                    good_size += len(line)
+                    self.records += 1
+            if good_size != os.path.getsize(self.path):
+                with open(self.path, 'r+b') as journal:
+                    journal.truncate(good_size)
+        self.journal_file = open(self.path, 'ab')
+        return dict(self.live)
+
+    def apply(self, record):
+        if record['op'] == RECORD_ADD:
+            self.live[record['url']] = record['attrs']
+        elif record['op'] == RECORD_REMOVE:
+            self.live.pop(record['url'], None)
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.apply(record)
+            self.journal_file.write(line)
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.records += 1
+            compact = (self.compacting is False and
+                       self.records >= self.compact_min_records and
+                       self.records > 2 * len(self.live))
+            if compact is True:
+                self.compacting = True
+        if compact is True:
+            thr = threading.Thread(target=self.compact,
+                                   name="SubscriptionJournalCompaction")
+            thr.daemon = True
+            thr.start()
+
+    def append_add(self, url, attrs):
+        self.append({'op': RECORD_ADD, 'url': url, 'attrs': attrs})
+
+    def append_remove(self, url):
+        self.append({'op': RECORD_REMOVE, 'url': url})
+
+    def compact(self):
+        """
+        Rewrites the journal with one add record per live subscription.
+        Records appended while the snapshot is written are copied over before
+        the rename. The temporary file is removed if the rename is not
+        reached
+        """
+        tmp_path = None
+        try:
+            with self.lock:
+                self.compacting = True
+                snapshot = dict(self.live)
+                offset = self.journal_file.tell()
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + '.',
+                dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'wb') as tmp:
+                for url, attrs in snapshot.items():
+                    tmp.write(json.dumps({'op': RECORD_ADD, 'url': url,
+                                          'attrs': attrs}) + '\n')
+                with self.lock:
+                    tail = 0
+                    with open(self.path, 'rb') as journal:
+                        journal.seek(offset)
+                        for line in journal:
+                            tmp.write(line)
+                            tail += 1
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                    os.rename(tmp_path, self.path)
+                    tmp_path = None
+                    fsync_directory(self.path)
+                    self.journal_file.close()
+                    self.journal_file = open(self.path, 'ab')
+                    self.records = len(snapshot) + tail
+        except (IOError, OSError) as e:
+            print 'journal compaction failed', e
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def close(self):
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+
+
+if __name__ == '__main__':
+    count = 10000
+    directory = tempfile.mkdtemp()
+    try:
+        attrs = {'Id': '0', 'Name': 'Event Subscription', 'Context': 'ctx'}
+        path = os.path.join(directory, 'subscriptions.journal')
+        journal = SubscriptionJournal(path, compact_min_records=count * 10)
+        journal.replay()
+        start = time.time()
+        for i in xrange(count):
+            journal.append_add('http://client%d/events' % i, attrs)
+        print "%d appends            : %.1f ms" % (
+            count, (time.time() - start) * 1000)
+        journal.close()
+
+        start = time.time()
+        live = SubscriptionJournal(path).replay()
+        print "replay of %d records : %.1f ms" % (
+            len(live), (time.time() - start) * 1000)
+
+        legacy_path = os.path.join(directory, 'subscriptions.json')
+        subscriptions = dict(('http://client%d/events' % i, attrs)
+                             for i in xrange(count))
+        start = time.time()
+        with open(legacy_path, 'w') as data_file:
+            json.dump(subscriptions, data_file)
+        print "one full rewrite        : %.1f ms" % (
+            (time.time() - start) * 1000)
+        start = time.time()
+        with open(legacy_path, 'r') as data_file:
+            json.load(data_file)
+        print "full file load          : %.1f ms" % (
+            (time.time() - start) * 1000)
+    finally:
+        shutil.rmtree(directory)
@@ -7,8 +7,6 @@ from redfish_resource import *
 Bottle. Does not belong to final release of the modules"""
 
 
-redfish_root = RedfishBottleRoot()
-
 get_paths = ['redfish',
              'redfish/v1',
              'redfish/v1/Systems',
@@ -25,7 +23,7 @@ get_paths = ['redfish',
              'redfish/v1/Chassis/1U/Thermal',
              'redfish/v1/uoio/1U/Thermal',
              'redfish/v1/Chassis/1U/dff',
-             'redfish/v1/$metadata',
+             'redfish/v1/odata',
              'redfish/v1/EventService',
              'redfish/v1/SessionService',
              'redfish/v1/SessionService/Sessions',
@@ -33,14 +31,17 @@ get_paths = ['redfish',
              'redfish/v1/SessionService/Sessions/1',
              'redfish/v1/Chassis/1U/Power']
 
-for path in get_paths:
-    path_list = path.split('/')
-    print "-----------------------------"
-    print path
-    print "-----------------------------"
-    jdata = redfish_root.get_json(path_list)
-    dic_data = json.loads(jdata)
-    if "error" in dic_data.keys():
-        print "THIS IS AN ERROR RESPONSE"
-    print json.dumps(json.loads(jdata), sort_keys=True,
-                     indent=4, separators=(',', ': '))
+if __name__ == '__main__':
+    redfish_root = RedfishBottleRoot()
+
+    for path in get_paths:
+        path_list = path.split('/')
+        print "-----------------------------"
+        print path
+        print "-----------------------------"
+        jdata = redfish_root.get_json(path_list)
+        dic_data = json.loads(jdata)
+        if "error" in dic_data.keys():
+            print "THIS IS AN ERROR RESPONSE"
+        print json.dumps(json.loads(jdata), sort_keys=True,
+                         indent=4, separators=(',', ': '))